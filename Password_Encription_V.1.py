@@ -1,14 +1,50 @@
+import csv
 import json
 import os
-from cryptography.fernet import Fernet
+import sys
+import time
+from cryptography.fernet import Fernet, InvalidToken
 import hashlib
 import base64
 from getpass import getpass
 
-DB_FILE = 'passwords.json'
+VAULT_FILE = 'passwords.vault' # Append-only log: a JSON header line, then one encrypted record per line
+DB_FILE = 'passwords.json' # Older vaults, migrated to VAULT_FILE on first unlock
+VAULT_FORMAT = 3
+# passwords.json formats: 1 was a flat {site: token} dict keyed by an unsalted
+# SHA-256 of the master password, 2 added {"format", "kdf", "check", "entries"}
+COMPACT_MIN_RECORDS = 64 # Don't bother compacting smaller logs
+SALT_SIZE = 16
+SCRYPT_COST = 2 ** 15 # Default scrypt N (~32 MB, roughly 0.1 s); tune with the calibrate command
+SCRYPT_BLOCK_SIZE = 8
+PBKDF2_ITERATIONS = 600000 # Used when hashlib has no scrypt (OpenSSL built without it)
+CALIBRATE_TARGET = 0.5 # Seconds an unlock should take after calibration
+CALIBRATE_MAX = 10 # Longest target accepted, in seconds
+CHECK_TEXT = b"vault-check" # Encrypted with the key so a wrong master password is caught at unlock
 
-def derive_key(master_password):
-    # Derive a 32-byte key from the master password
+def new_kdf(cost=None):
+    """KDF parameters with a fresh salt: scrypt if available, else PBKDF2."""
+    salt = base64.b64encode(os.urandom(SALT_SIZE)).decode()
+    if hasattr(hashlib, "scrypt"):
+        return {"name": "scrypt", "salt": salt, "n": cost or SCRYPT_COST, "r": SCRYPT_BLOCK_SIZE, "p": 1}
+    return {"name": "pbkdf2_sha256", "salt": salt, "iterations": cost or PBKDF2_ITERATIONS}
+
+def derive_key(master_password, kdf):
+    # Derive a 32-byte Fernet key from the master password with a salted, slow KDF
+    password = master_password.encode()
+    salt = base64.b64decode(kdf["salt"])
+    if kdf["name"] == "scrypt":
+        n, r, p = kdf["n"], kdf["r"], kdf["p"]
+        digest = hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=32,
+                                maxmem=256 * r * (n + p + 2)) # Default maxmem (32 MB) is too small for big N
+    elif kdf["name"] == "pbkdf2_sha256":
+        digest = hashlib.pbkdf2_hmac("sha256", password, salt, kdf["iterations"], dklen=32)
+    else:
+        raise ValueError(f"Unknown KDF {kdf['name']!r}")
+    return base64.urlsafe_b64encode(digest)
+
+def legacy_key(master_password):
+    # Format 1 key, only used to migrate old vaults
     digest = hashlib.sha256(master_password.encode()).digest()
     return base64.urlsafe_b64encode(digest)
 
@@ -18,68 +54,329 @@ def load_passwords():
     with open(DB_FILE, 'r') as f:
         return json.load(f)
 
-def save_passwords(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f)
+def old_passwords(master_password):
+    """Decrypts DB_FILE (format 1 or 2) for migration; returns (passwords, undecryptable entries).
 
-def add_password(master_password):
-    site = input("Enter site name: ")
-    password = getpass("Enter password for the site: ")
+    Format 1 let each entry be added under a different master password, so
+    entries this one doesn't open are returned as they are rather than
+    failing the migration. Raises InvalidToken if it opens none of them.
+    """
+    data = load_passwords()
+    if data.get("format") == 2:
+        fernet = Fernet(derive_key(master_password, data["kdf"]))
+        fernet.decrypt(data["check"].encode())
+        data = data["entries"]
+    else:
+        fernet = Fernet(legacy_key(master_password))
+    passwords, skipped = {}, {}
+    for site, token in data.items():
+        try:
+            passwords[site] = fernet.decrypt(token.encode()).decode()
+        except InvalidToken:
+            skipped[site] = token
+    if skipped and not passwords:
+        raise InvalidToken
+    return passwords, skipped
+
+def fsync_dir(path):
+    # Makes a rename durable; directories can't be opened on Windows
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class VaultSession:
+    """An unlocked vault: the key is derived once and every password is decrypted into memory.
+
+    Lookups are dictionary reads. VAULT_FILE is a header line followed by
+    one Fernet token per {"site", "password"} change, so adding passwords
+    appends and fsyncs just those lines;
+    a crash can only tear the last line, which is dropped on the next
+    unlock. Once most of the log is superseded records it is compacted
+    into a fresh snapshot, written to a temp file and renamed over it.
+    """
+
+    def __init__(self, kdf, key, passwords, records=0):
+        self.kdf = kdf
+        self.fernet = Fernet(key)
+        self.passwords = passwords # site -> plaintext password
+        self.records = records # Record lines in VAULT_FILE
+
+    @classmethod
+    def unlock(cls, master_password):
+        """Opens VAULT_FILE (creating it, or migrating DB_FILE); raises ValueError for a wrong master password."""
+        if not os.path.exists(VAULT_FILE):
+            return cls._create(master_password)
+        with open(VAULT_FILE, 'rb') as f:
+            header = json.loads(f.readline())
+            key = derive_key(master_password, header["kdf"])
+            fernet = Fernet(key)
+            try:
+                fernet.decrypt(header["check"].encode())
+            except InvalidToken:
+                raise ValueError("Incorrect master password!")
+            passwords, records = {}, 0
+            good_end = f.tell()
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise InvalidToken # Torn append
+                    record = json.loads(fernet.decrypt(line.strip()))
+                except (InvalidToken, ValueError):
+                    if f.read(1):
+                        raise ValueError(f"{VAULT_FILE} is damaged after record {records}.")
+                    break
+                passwords[record["site"]] = record["password"]
+                records += 1
+                good_end += len(line)
+        if good_end != os.path.getsize(VAULT_FILE):
+            print(f"Discarding an incomplete record at the end of {VAULT_FILE}.")
+            os.truncate(VAULT_FILE, good_end)
+        return cls(header["kdf"], key, passwords, records)
+
+    @classmethod
+    def _create(cls, master_password):
+        # New vault, or the first unlock since passwords.json: re-encrypt into a log
+        try:
+            passwords, skipped = old_passwords(master_password)
+        except InvalidToken:
+            raise ValueError("Incorrect master password!")
+        kdf = new_kdf()
+        session = cls(kdf, derive_key(master_password, kdf), passwords)
+        session.snapshot()
+        if skipped:
+            # Saved under another master password: keep only those, in the old format,
+            # and make sure they are on disk before passwords.json goes
+            with open(DB_FILE + ".unmigrated", 'w') as f:
+                json.dump(skipped, f)
+                f.flush()
+                os.fsync(f.fileno())
+            fsync_dir(DB_FILE + ".unmigrated")
+        if os.path.exists(DB_FILE):
+            # Its unsalted key is what the new vault replaces, so don't leave a copy behind
+            os.remove(DB_FILE)
+            print(f"Migrated {len(passwords)} passwords from {DB_FILE} to {VAULT_FILE}.")
+        if skipped:
+            print(f"{len(skipped)} passwords were saved with a different master password and were not migrated: "
+                  f"{', '.join(sorted(skipped))}. They are kept in {DB_FILE}.unmigrated.")
+        return session
+
+    def sites(self):
+        return sorted(self.passwords)
+
+    def get(self, site):
+        return self.passwords.get(site)
 
-    key = derive_key(master_password)
-    fernet = Fernet(key)
-    encrypted = fernet.encrypt(password.encode())
+    def add(self, site, password):
+        self.add_many([(site, password)])
 
-    passwords = load_passwords()
-    passwords[site] = encrypted.decode()
-    save_passwords(passwords)
+    def add_many(self, items):
+        """Adds or replaces (site, password) pairs with one append and one fsync."""
+        items = list(items)
+        lines = b"".join(self.fernet.encrypt(json.dumps({"site": site, "password": password}).encode()) + b"\n"
+                         for site, password in items)
+        with open(VAULT_FILE, 'ab') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.passwords.update(items)
+        self.records += len(items)
+        if self.records > max(COMPACT_MIN_RECORDS, 2 * len(self.passwords)):
+            self.snapshot()
+
+    def rekey(self, master_password, kdf):
+        """Re-encrypts everything under a key derived with new KDF parameters."""
+        self.kdf = kdf
+        self.fernet = Fernet(derive_key(master_password, kdf))
+        self.snapshot()
+
+    def snapshot(self):
+        """Rewrites VAULT_FILE as a header plus one record per site, atomically."""
+        header = {"format": VAULT_FORMAT, "kdf": self.kdf, "check": self.fernet.encrypt(CHECK_TEXT).decode()}
+        temp_path = VAULT_FILE + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for site, password in self.passwords.items():
+                f.write(self.fernet.encrypt(json.dumps({"site": site, "password": password}).encode()) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, VAULT_FILE)
+        fsync_dir(VAULT_FILE)
+        self.records = len(self.passwords)
+
+
+def read_import(path):
+    """(site, password) pairs from a CSV file: site,password rows, or a browser
+    export with a header naming name/url/site and password columns."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        return []
+    header = [column.strip().lower() for column in rows[0]]
+    if "password" in header:
+        site_column = next((header.index(name) for name in ("site", "name", "url") if name in header), 0)
+        password_column = header.index("password")
+        rows = rows[1:]
+    else:
+        site_column, password_column = 0, 1
+    return [(row[site_column], row[password_column]) for row in rows if len(row) > max(site_column, password_column)]
+
+
+def calibrate(target_seconds=CALIBRATE_TARGET):
+    """Returns KDF parameters whose key derivation takes about target_seconds here."""
+    kdf = new_kdf()
+    if kdf["name"] == "scrypt":
+        # Memory and time both grow with N, so double it until we reach the target
+        n = 2 ** 12
+        while True:
+            kdf["n"] = n
+            started = time.perf_counter()
+            derive_key("calibration", kdf)
+            elapsed = time.perf_counter() - started
+            if elapsed >= target_seconds or n >= 2 ** 20:
+                break
+            n *= 2
+        # Take whichever of N and N/2 lands closer to the target
+        if n > 2 ** 12 and elapsed - target_seconds > target_seconds - elapsed / 2:
+            kdf["n"], elapsed = n // 2, elapsed / 2
+    else:
+        # PBKDF2 time is linear in the iteration count: measure once and scale,
+        # then time the chosen count (the 100000 floor may overshoot the target)
+        kdf["iterations"] = 100000
+        started = time.perf_counter()
+        derive_key("calibration", kdf)
+        elapsed = time.perf_counter() - started
+        kdf["iterations"] = max(100000, int(100000 * target_seconds / elapsed))
+        started = time.perf_counter()
+        derive_key("calibration", kdf)
+        elapsed = time.perf_counter() - started
+    return kdf, elapsed
+
+def parse_target(text):
+    """Seconds for calibrate from user input; blank means CALIBRATE_TARGET. Raises ValueError."""
+    if not text.strip():
+        return CALIBRATE_TARGET
+    seconds = float(text)
+    if not 0 < seconds <= CALIBRATE_MAX: # Also rejects nan
+        raise ValueError(f"the target must be more than 0 and at most {CALIBRATE_MAX} seconds")
+    return seconds
+
+def describe_kdf(kdf):
+    if kdf["name"] == "scrypt":
+        return f"scrypt N=2^{kdf['n'].bit_length() - 1}, r={kdf['r']}, p={kdf['p']}"
+    return f"PBKDF2-SHA256, {kdf['iterations']} iterations"
+
+
+def unlock_vault():
+    master = getpass("Enter master password: ")
+    started = time.perf_counter()
+    try:
+        session = VaultSession.unlock(master)
+    except ValueError as e:
+        print(e)
+        return None, None
+    print(f"Vault unlocked in {time.perf_counter() - started:.2f}s ({describe_kdf(session.kdf)}).")
+    return session, master
+
+def add_password(session):
+    site = input("Enter site name: ")
+    password = getpass("Enter password for the site: ")
+    session.add(site, password)
     print(f"Password for {site} saved successfully.")
 
-def view_sites():
-    passwords = load_passwords()
-    if not passwords:
+def view_sites(session):
+    sites = session.sites()
+    if not sites:
         print("No passwords saved.")
         return
     print("Saved sites:")
-    for site in passwords.keys():
+    for site in sites:
         print(f"- {site}")
 
-def get_password(master_password):
+def get_password(session):
     site = input("Enter the site you want the password for: ")
-    passwords = load_passwords()
-    if site not in passwords:
+    password = session.get(site)
+    if password is None:
         print("Site not found.")
         return
-    key = derive_key(master_password)
-    fernet = Fernet(key)
+    print(f"Password for {site}: {password}")
+
+def import_passwords(session, path=None):
+    path = path or input("CSV file to import (site,password per row): ").strip()
     try:
-        decrypted = fernet.decrypt(passwords[site].encode()).decode()
-        print(f"Password for {site}: {decrypted}")
-    except Exception:
-        print("Incorrect master password!")
+        items = read_import(path)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print(f"Could not read {path}: {e}")
+        return
+    started = time.perf_counter()
+    session.add_many(items)
+    print(f"Imported {len(items)} passwords in {time.perf_counter() - started:.2f}s.")
+
+def calibrate_vault(session, master, target_seconds=CALIBRATE_TARGET):
+    print(f"Measuring key derivation (target {target_seconds}s)...")
+    kdf, elapsed = calibrate(target_seconds)
+    print(f"Chose {describe_kdf(kdf)}: about {elapsed:.2f}s per unlock.")
+    if session is not None:
+        session.rekey(master, kdf)
+        print("Vault re-encrypted with the new setting.")
 
 def main():
     print("=== Password Manager ===")
+    session = master = None # Unlocked on first use, then kept until exit
     while True:
         print("\nOptions:")
         print("1. Add new password")
         print("2. View saved sites")
         print("3. Get password for site")
-        print("4. Exit")
+        print("4. Calibrate unlock time")
+        print("5. Import passwords from CSV")
+        print("6. Exit")
         choice = input("Choose an option: ")
 
+        if choice in ('1', '2', '3', '4', '5') and session is None: # Site names are encrypted too
+            session, master = unlock_vault()
+            if session is None:
+                continue
         if choice == '1':
-            master = getpass("Enter master password: ")
-            add_password(master)
+            add_password(session)
         elif choice == '2':
-            view_sites()
+            view_sites(session)
         elif choice == '3':
-            master = getpass("Enter master password: ")
-            get_password(master)
+            get_password(session)
         elif choice == '4':
+            while True:
+                try:
+                    target = parse_target(input(f"Target unlock time in seconds [{CALIBRATE_TARGET}]: "))
+                    break
+                except ValueError:
+                    print(f"Please enter a number of seconds up to {CALIBRATE_MAX}, e.g. {CALIBRATE_TARGET}.")
+            calibrate_vault(session, master, target)
+        elif choice == '5':
+            import_passwords(session)
+        elif choice == '6':
             break
         else:
             print("Invalid option.")
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['calibrate']:
+        # python Password_Encription_V.1.py calibrate [seconds]: re-key the vault for this machine
+        try:
+            target = parse_target(sys.argv[2] if len(sys.argv) > 2 else "")
+        except ValueError as e:
+            sys.exit(f"Invalid target {sys.argv[2]!r}: {e}")
+        session, master = unlock_vault()
+        if session is not None:
+            calibrate_vault(session, master, target)
+    elif sys.argv[1:2] == ['import'] and len(sys.argv) == 3:
+        # python Password_Encription_V.1.py import passwords.csv: bulk add with a single fsync
+        session, master = unlock_vault()
+        if session is not None:
+            import_passwords(session, sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,344 @@
+"""Load test for the server variants.
+
+Starts a server script on a local port in a scratch directory with a
+generated shared folder, drives concurrent keep-alive clients through each
+scenario and prints throughput and latency percentiles as JSON:
+
+    python benchmark.py --variant v4 --variant v3 --files 500 --duration 10 -o results.json
+    python benchmark.py --variant v4 --compare results.json  # exit 1 on a p95 regression
+
+Only the standard library is used, so it runs wherever the servers do.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import quote, urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# --- Variants ---
+# What each server script calls its endpoints. None means the variant has
+# no such endpoint and the scenario is skipped for it.
+VARIANTS = {
+    "v4": {
+        "script": "server_v.4.py", "args": [], "template": True,
+        "index": "/", "files": "/api/files", "note_read": "/api/note",
+        "note_write": ("/api/note", "json"), "download": "/shared/{name}",
+        "upload": ("/api/upload", "files[]"),
+    },
+    "v4-asyncio": {
+        "script": "server_v.4.py", "args": ["--engine", "asyncio"], "template": True,
+        "index": "/", "files": "/api/files", "note_read": "/api/note",
+        "note_write": ("/api/note", "json"), "download": "/shared/{name}",
+        "upload": ("/api/upload", "files[]"),
+    },
+    "v3": {
+        "script": "server_v.3.py", "args": [], "template": False,
+        "index": "/", "files": None, "note_read": None, # Both are part of the landing page
+        "note_write": ("/save_note", "form"), "download": "/{name}",
+        "upload": ("/upload", "file"),
+    },
+    "v0": {
+        "script": "server.py", "args": [], "template": False,
+        "index": "/", "files": None, "note_read": None,
+        "note_write": ("/save_note", "form"), "download": "/shared/{name}",
+        "upload": ("/upload", "file"),
+    },
+}
+# server_v.1.py doesn't start (do_POST is outside the handler class) and
+# server_v.2.py parses uploads as urlencoded forms, so neither is listed.
+
+SCENARIOS = ["index", "files", "note_read", "note_write", "download", "upload"]
+
+WORDS = ("lecture notes homework chapter exercise solution reading list exam revision "
+         "week module outline tutorial assignment project report draft summary").split()
+
+
+# --- Fixtures ---
+
+def generate_shared(folder, count, size, seed):
+    """Writes `count` files of about `size` bytes: half text, half random bytes."""
+    rng = random.Random(seed)
+    names = []
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        if i % 2 == 0:
+            name = f"{rng.choice(WORDS)}-{i:05d}.txt"
+            words = rng.choices(WORDS, k=size // 5 + 1) # Shortest word + space is 5 bytes
+            data = " ".join(words).encode()[:size]
+        else:
+            name = f"{rng.choice(WORDS)}-{i:05d}.bin"
+            data = rng.randbytes(size)
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(data)
+        names.append(name)
+    return names
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """One server variant running in its own scratch directory."""
+
+    def __init__(self, variant, config):
+        self.variant = variant
+        self.spec = VARIANTS[variant]
+        self.config = config
+        self.port = config.port or free_port()
+        self.workdir = tempfile.mkdtemp(prefix=f"bench-{variant}-")
+        self.process = None
+
+    def __enter__(self):
+        shutil.copy(os.path.join(HERE, self.spec["script"]), self.workdir)
+        if self.spec["template"]:
+            shutil.copy(os.path.join(HERE, "template.html"), self.workdir)
+        with open(os.path.join(self.workdir, "note.txt"), "w", encoding="utf-8") as f:
+            f.write("Benchmark note\n")
+        self.files = generate_shared(os.path.join(self.workdir, "shared"), self.config.files,
+                                     self.config.file_size, self.config.seed)
+        self.log = open(os.path.join(self.workdir, "server.log"), "wb")
+        command = [sys.executable, self.spec["script"], str(self.port)] + self.spec["args"]
+        self.process = subprocess.Popen(command, cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT)
+        self._wait_until_listening()
+        return self
+
+    def _wait_until_listening(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.variant} exited with {self.process.returncode}, "
+                                   f"see {self.log.name}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{self.variant} didn't start listening on port {self.port}")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+        if not self.config.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# --- Requests ---
+
+def multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def build_request(scenario, spec, server, worker, n, payload):
+    """(method, path, body, headers) for the n-th request of a worker."""
+    if scenario == "download":
+        name = server.files[(worker * 7919 + n) % len(server.files)]
+        return "GET", spec["download"].format(name=quote(name)), None, {}
+    if scenario == "note_write":
+        path, kind = spec["note_write"]
+        text = f"Note from client {worker}, edit {n}\n" + payload.decode()
+        if kind == "json":
+            return "POST", path, json.dumps({"note": text}).encode(), {"Content-Type": "application/json"}
+        return "POST", path, urlencode({"note": text}).encode(), {"Content-Type": "application/x-www-form-urlencoded"}
+    if scenario == "upload":
+        path, field = spec["upload"]
+        body, content_type = multipart(field, f"upload-{worker}-{n}.bin", payload)
+        return "POST", path, body, {"Content-Type": content_type}
+    return "GET", spec[scenario], None, {}
+
+def run_scenario(server, scenario, config):
+    """Runs one scenario with config.concurrency clients; returns its result dict."""
+    spec = server.spec
+    rng = random.Random(config.seed)
+    payload = {"upload": rng.randbytes(config.upload_size),
+               "note_write": " ".join(rng.choice(WORDS) for _ in range(config.note_words)).encode()}.get(scenario, b"")
+    latencies, errors, statuses = [], [0], {}
+    received = [0]
+    lock = threading.Lock()
+    start_line = threading.Barrier(config.concurrency + 1)
+    stop = threading.Event()
+    budget = iter(range(config.requests)) if config.requests else None
+
+    def client(worker):
+        connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=60)
+        mine, n, size = [], 0, 0
+        start_line.wait()
+        while not stop.is_set():
+            if budget is not None:
+                with lock:
+                    if next(budget, None) is None:
+                        break
+            method, path, body, headers = build_request(scenario, spec, server, worker, n, payload)
+            n += 1
+            began = time.perf_counter()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                size += len(response.read())
+                status = response.status
+                if response.will_close:
+                    connection.close() # http.client reconnects on the next request
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status = "error"
+            elapsed = time.perf_counter() - began
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "error" or status >= 400:
+                    errors[0] += 1
+                else:
+                    mine.append(elapsed)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            received[0] += size
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(config.concurrency)]
+    for thread in threads:
+        thread.start()
+    start_line.wait()
+    began = time.perf_counter()
+    if budget is None:
+        stop.wait(config.duration)
+        stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    latencies.sort()
+    return {
+        "variant": server.variant,
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "bytes_per_second": round(received[0] / elapsed),
+        "latency_ms": latency_summary(latencies),
+    }
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-fraction * len(sorted_values) // 1))) # ceil
+    return sorted_values[rank - 1]
+
+def latency_summary(latencies):
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        "p50": ms(percentile(latencies, 0.50)),
+        "p95": ms(percentile(latencies, 0.95)),
+        "p99": ms(percentile(latencies, 0.99)),
+        "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max": ms(latencies[-1]) if latencies else None,
+    }
+
+
+# --- Comparison ---
+
+def compare(results, baseline_file, tolerance):
+    """Lists results whose p95 latency or throughput got worse than the baseline by more than `tolerance`."""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {(r["variant"], r["scenario"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["variant"], result["scenario"]))
+        if before is None:
+            continue
+        old_p95, new_p95 = before["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        if old_p95 and new_p95 and new_p95 > old_p95 * (1 + tolerance):
+            regressions.append({"variant": result["variant"], "scenario": result["scenario"],
+                                "metric": "p95_ms", "baseline": old_p95, "current": new_p95})
+        old_rps, new_rps = before["requests_per_second"], result["requests_per_second"]
+        if old_rps and new_rps < old_rps * (1 - tolerance):
+            regressions.append({"variant": result["variant"], "scenario": result["scenario"],
+                                "metric": "requests_per_second", "baseline": old_rps, "current": new_rps})
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the file sharing server variants.")
+    parser.add_argument("--variant", action="append", choices=sorted(VARIANTS),
+                        help="Server variant to test (repeatable, default v4).")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to run (repeatable, default all the variant supports).")
+    parser.add_argument("--files", type=int, default=200, help="Files in the generated shared folder.")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="Size of each shared file in bytes.")
+    parser.add_argument("--upload-size", type=int, default=256 * 1024, help="Size of each uploaded file in bytes.")
+    parser.add_argument("--note-words", type=int, default=200, help="Words in each saved note.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients per scenario.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per scenario.")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="Run a fixed number of requests per scenario instead of --duration.")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed requests per scenario first.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated files and payloads.")
+    parser.add_argument("--port", type=int, default=0, help="Port for the server (default: any free port).")
+    parser.add_argument("--keep", action="store_true", help="Keep each variant's scratch directory and log.")
+    parser.add_argument("-o", "--output", help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--compare", metavar="REPORT", help="Earlier report to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown against --compare before failing (default 0.2 = 20%%).")
+    return parser.parse_args(argv)
+
+
+# --- Main execution ---
+if __name__ == "__main__":
+    config = parse_args()
+    results = []
+    for variant in config.variant or ["v4"]:
+        with ServerProcess(variant, config) as server:
+            for scenario in config.scenario or SCENARIOS:
+                if server.spec[scenario] is None:
+                    continue
+                if config.warmup:
+                    run_scenario(server, scenario, argparse.Namespace(**dict(
+                        vars(config), requests=config.warmup, concurrency=min(config.concurrency, config.warmup))))
+                result = run_scenario(server, scenario, config)
+                results.append(result)
+                latency = result["latency_ms"]
+                print(f"{variant:>10} {scenario:<10} {result['requests_per_second']:>9} req/s  "
+                      f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms  "
+                      f"errors {result['errors']}", file=sys.stderr)
+
+    report = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {key: value for key, value in vars(config).items() if key not in ("output", "compare", "keep")},
+        "results": results,
+    }
+    if config.compare:
+        report["regressions"] = compare(results, config.compare, config.tolerance)
+    text = json.dumps(report, indent=2)
+    if config.output:
+        with open(config.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report.get("regressions"):
+        sys.exit(1)
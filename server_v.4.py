@@ -1,34 +1,387 @@
 import http.server
+import http.client
 import socketserver
+import asyncio
+import io
 import os
 import sys
-import cgi
 import json
+import gzip
+import zlib
+import hashlib
+import tempfile
+import select
+import socket
+import threading
+import uuid
+import errno
+import base64
+import bisect
+import re
+import fnmatch
+import math
+import queue
 import mimetypes
-from urllib.parse import unquote, quote
+import argparse
+import zipfile
+import codecs
+from xml.etree import ElementTree
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from email.parser import HeaderParser
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
+from urllib.parse import unquote, quote, parse_qs
 from datetime import datetime
 import time # For modification times
-import shutil # For copyfileobj
+import cProfile
+import random
+import signal
+import contextlib
+try:
+    import fcntl # Locks shared by --processes workers; not available on Windows
+except ImportError:
+    fcntl = None
 
-PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+PORT = 8000 # Default port, override with the first command line argument
 SHARED_FOLDER = "./shared"
-NOTE_FILE = "note.txt" # Store outside shared folder
+NOTE_FILE = "note.txt" # Plain-text copy of the note, refreshed when NOTE_LOG_FILE is compacted
+NOTE_LOG_FILE = "note_log.jsonl" # The live note: snapshot + append-only edit log (outside the shared folder)
 LAST_CHANGE_FILE = "last_change.txt" # To persist last change time
 TEMPLATE_FILE = "template.html"
+WORKER_POOL_SIZE = 16 # Threads serving requests concurrently (--workers)
+KEEPALIVE_TIMEOUT = 15 # Seconds an idle keep-alive connection may hold a worker (less if others are queued)
+IDLE_POLL_INTERVAL = 0.05 # Seconds between an idle connection's checks for queued connections
+IDLE_RELEASE_AFTER = 0.5 # Seconds idle before a connection makes way for a queued one
+ASYNC_KEEPALIVE_TIMEOUT = 300 # Idle connections are cheap in the asyncio engine
+READ_CHUNK_SIZE = 64 * 1024 # Bytes per read when streaming bodies and files
+UPLOAD_TEMP_PREFIX = ".~upload-" # In-progress uploads, renamed into place when complete
+MAX_RANGES = 16 # More ranges than this in one request are answered with the whole file
+BOOT_ID = uuid.uuid4().hex[:8] # Event ids are only meaningful to the process that sent them
+TEMPLATE_CHECK_INTERVAL = 1.0 # Seconds between checks of the template file for edits
+COMPRESSION_CACHE_FOLDER = ".compressed_cache" # Precompressed copies of shared text files
+COMPRESSION_CACHE_MAX_SIZE = 256 * 1024 * 1024 # Oldest copies are removed beyond this many bytes
+COMPRESS_MIN_SIZE = 1024 # Smaller bodies aren't worth compressing
+LISTING_PAGE_SIZE = 200 # Default entries per /api/files page (limit=)
+LISTING_MAX_PAGE_SIZE = 1000
+LISTING_MAX_DEPTH = 32
+NOTE_COMPACT_OPS = 200 # Compact the note log after this many edits
+EVENTS_POLL_INTERVAL = 2.0 # Seconds between shared-folder checks while /api/events has listeners
+EVENTS_HEARTBEAT_INTERVAL = 15.0 # Keeps idle event streams (and proxies) alive
+EVENTS_BACKLOG = 256 # Recent events kept for clients reconnecting with Last-Event-ID
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024 # Suggested bytes per PUT to a resumable upload session
+UPLOAD_SESSION_TTL = 24 * 3600 # Seconds an untouched upload session is kept before it is removed
+BLOB_FOLDER_NAME = ".blobs" # Content-addressed store inside the shared folder (hardlink targets)
+PREVIEW_CHARS = 500 # Default snippet length for /api/preview (chars=)
+PREVIEW_MAX_CHARS = 5000
+PREVIEW_CACHE_BYTES = 4 * 1024 * 1024 # Budget for cached snippets
+PREVIEW_MAX_XML_BYTES = 16 * 1024 * 1024 # Give up on a document part after inflating this much XML
+SEARCH_INDEX_FILE = "search_index.json" # Extracted text of the shared documents, kept across restarts
+SEARCH_MAX_CHARS = 200000 # Text indexed per document
+SEARCH_COMPACT_MIN_RECORDS = 64 # Don't bother compacting smaller index logs
+SEARCH_SYNC_INTERVAL = 30.0 # Seconds between checks for files changed outside the server (while searching)
+SEARCH_RESULTS = 20 # Default results per /api/search (limit=)
+HIDDEN_CACHE_SIZE = 1 << 17 # Memoized hidden/visible verdicts (distinct names)
+CLIENT_RATE_LIMIT = 0 # Bytes/s per client IP for downloads and uploads, 0 = unlimited (--client-limit)
+GLOBAL_RATE_LIMIT = 0 # Bytes/s for all shaped transfers together, 0 = unlimited (--global-limit)
+SHAPING_SLICE = 64 * 1024 # Bytes sent between shaping decisions
+SHAPING_BURST = 0.25 # Seconds of a transfer's rate it may send at once after a pause
+SHAPING_CLIENT_TTL = 600 # Seconds an idle client's usage is kept for /api/bandwidth
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Seconds, /api/metrics
+PROFILE_RATE = 0.0 # Fraction of requests run under cProfile (SERVER_PROFILE_RATE or /api/profiling)
+PROFILE_SLOW_MS = 0 # Requests slower than this are always profiled, 0 = off (SERVER_PROFILE_SLOW_MS)
+PROFILE_FOLDER = "profiles" # Where .prof files go (SERVER_PROFILE_DIR)
+PROFILE_KEEP = 200 # Newest profiles kept, older ones are deleted
+PROFILE_SETTINGS_FILE = "profiling.json" # Settings shared by --processes workers
+PROFILE_SYNC_INTERVAL = 1.0 # Seconds between a worker's checks of PROFILE_SETTINGS_FILE
+WORKER_RESTART_DELAY = 1.0 # Seconds before restarting a worker process that keeps dying (--processes)
 
 # Create shared folder if it doesn't exist
 if not os.path.exists(SHARED_FOLDER):
     os.makedirs(SHARED_FOLDER)
 
-# List of files/patterns to hide in the listing
+# Files and folders matching these globs (or the regexes below) are hidden
+# everywhere: listing, /shared/ downloads, previews, search and ZIP export.
+# More can be added at startup with --hide.
 HIDDEN_PATTERNS = [
-    ".~lock.*", # Example pattern
+    ".~lock.*", # LibreOffice lock files
+    UPLOAD_TEMP_PREFIX + "*", # Partial uploads
+    BLOB_FOLDER_NAME,
     NOTE_FILE,
+    NOTE_LOG_FILE,
+    SEARCH_INDEX_FILE,
     LAST_CHANGE_FILE,
     TEMPLATE_FILE,
     os.path.basename(__file__), # Hide the script itself
     # Add any other files or patterns you want to hide
 ]
+HIDDEN_REGEXES = [
+    r"(?i:desktop\.ini|thumbs\.db|\.ds_store)", # Folder metadata written by Windows and macOS
+]
+
+# --- Logging and Metrics ---
+
+_log_lock = threading.Lock()
+
+def log(level, message, **fields):
+    """Writes one JSON object per line to stderr: time, level, message and fields."""
+    entry = {"time": datetime.now().isoformat(timespec="milliseconds"), "level": level, "msg": message}
+    entry.update(fields)
+    line = json.dumps(entry, default=str) + "\n" # Exceptions and paths become strings
+    with _log_lock: # One write per line, so lines from different threads don't interleave
+        sys.stderr.write(line)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Request counts, latency histograms and byte counters per route.
+
+    Recording a request is a bisect and a few dict updates under one lock,
+    cheap enough to leave on. Histogram buckets are counted individually
+    and only made cumulative when /api/metrics is rendered.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = Counter() # (route, method, status) -> count
+        self._latency = {} # route -> [count per bucket..., +Inf count, sum of seconds]
+        self._bytes_in = Counter() # route -> request body bytes
+        self._bytes_out = Counter() # route -> response body bytes
+        self._connections = 0
+        self._in_flight = 0
+        self._started = time.time()
+
+    def connection_opened(self):
+        with self._lock:
+            self._connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self._connections -= 1
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self, route, method, status, seconds, bytes_in, bytes_out):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._in_flight -= 1
+            self._requests[route, method, status] += 1
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = [0] * (len(self.buckets) + 1) + [0.0]
+            latency[index] += 1
+            latency[-1] += seconds
+            self._bytes_in[route] += bytes_in
+            self._bytes_out[route] += bytes_out
+
+    def render(self):
+        """The metrics in Prometheus text exposition format."""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            latencies = sorted((route, list(latency)) for route, latency in self._latency.items())
+            bytes_in, bytes_out = sorted(self._bytes_in.items()), sorted(self._bytes_out.items())
+            connections, in_flight = self._connections, self._in_flight
+        lines = ["# HELP http_requests_total Requests answered, by route, method and status.",
+                 "# TYPE http_requests_total counter"]
+        for (route, method, status), count in requests:
+            lines.append(f'http_requests_total{{route="{_label(route)}",method="{_label(method)}",'
+                         f'status="{status}"}} {count}')
+        lines += ["# HELP http_request_duration_seconds Time from request headers to the end of the response.",
+                  "# TYPE http_request_duration_seconds histogram"]
+        for route, latency in latencies:
+            route = _label(route)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), latency):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {latency[-1]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {cumulative}')
+        for name, help_text, totals in (
+                ("http_request_body_bytes_total", "Request body bytes read.", bytes_in),
+                ("http_response_body_bytes_total", "Response body bytes sent.", bytes_out)):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines.extend(f'{name}{{route="{_label(route)}"}} {total}' for route, total in totals)
+        for name, help_text, value in (
+                ("http_connections_active", "Open client connections.", connections),
+                ("http_requests_in_flight", "Requests being handled or sent.", in_flight),
+                ("event_stream_clients", "Clients subscribed to /api/events.", CHANGE_FEED.subscribers),
+                ("process_start_time_seconds", "Unix time the server started.", self._started)):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+def record_request(request, response, started):
+    """Counts a finished request in METRICS and writes its access log line."""
+    seconds = time.perf_counter() - started
+    client = request.client_address[0] if request.client_address else "-"
+    bytes_in = request.body.length - max(request.body.remaining, 0)
+    METRICS.request_finished(request.route, request.method, response.status, seconds, bytes_in, response.sent)
+    log("info", "request", client=client, method=request.method, target=request.target, route=request.route,
+        status=response.status, bytes_in=bytes_in, bytes_out=response.sent, duration_ms=round(seconds * 1000, 3),
+        user_agent=request.headers.get("User-Agent"))
+
+
+# --- Profiling ---
+
+class ProfileSample:
+    """Phase timings, and maybe a cProfile run, for one request."""
+
+    def __init__(self, parse_seconds, profile, sampled):
+        self.phases = {"parse": parse_seconds, "route": 0.0, "send": 0.0}
+        self.profile = profile
+        self.sampled = sampled # Chosen by the sampling rate: saved however fast it was
+        self._routed = time.perf_counter()
+
+    def call(self, function, *args):
+        """Runs the route (body reading and filesystem work) under the profiler."""
+        start = time.perf_counter()
+        if self.profile is not None:
+            try:
+                self.profile.enable()
+            except ValueError: # Python 3.12+ allows one active profiler per process
+                self.profile = None
+        try:
+            return function(*args)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            self._routed = time.perf_counter()
+            self.phases["route"] = self._routed - start
+
+    def sent(self):
+        self.phases["send"] = time.perf_counter() - self._routed
+
+
+class Profiler:
+    """Profiles a sampled fraction of requests, plus any slower than a threshold.
+
+    Off by default, and then engines only test `active`. With a slow
+    threshold every request is profiled (there's no telling in advance
+    which will be slow) but only slow or sampled ones are saved: as
+    <time>-<ms>ms-<method>-<route>.prof for pstats/snakeviz, with a .json
+    next to it holding the parse/route/send breakdown. Only the newest
+    `keep` profiles are kept.
+
+    With `settings_file` set (--processes), update() writes the settings
+    there and every worker picks them up within PROFILE_SYNC_INTERVAL.
+    """
+
+    def __init__(self, folder=PROFILE_FOLDER, keep=PROFILE_KEEP, rate=PROFILE_RATE, slow_ms=PROFILE_SLOW_MS):
+        self.folder = folder
+        self.keep = keep
+        self.rate = rate
+        self.slow_ms = slow_ms
+        self.settings_file = None
+        self._lock = threading.Lock()
+        self._saved = None # deque of saved profile names, oldest first, loaded on first save
+        self._synced = 0.0 # time.monotonic() of the last settings_file check
+        self._settings_key = None # (inode, mtime_ns) of settings_file as last read
+
+    @property
+    def active(self):
+        if self.settings_file is not None and time.monotonic() - self._synced >= PROFILE_SYNC_INTERVAL:
+            self._sync()
+        return self.rate > 0 or self.slow_ms > 0
+
+    def update(self, rate=None, slow_ms=None):
+        """configure() for the whole server: shared with the other worker processes, if any."""
+        with self._lock:
+            self.configure(rate, slow_ms)
+            if self.settings_file is not None:
+                self.share()
+
+    def share(self):
+        write_atomic(self.settings_file, json.dumps({"rate": self.rate, "slowMs": self.slow_ms}))
+        stat = os.stat(self.settings_file)
+        self._settings_key = (stat.st_ino, stat.st_mtime_ns)
+
+    def _sync(self):
+        self._synced = time.monotonic()
+        try:
+            stat = os.stat(self.settings_file)
+            if (stat.st_ino, stat.st_mtime_ns) == self._settings_key:
+                return
+            with open(self.settings_file, "r", encoding="utf-8") as f:
+                settings = json.load(f)
+            self.configure(settings.get("rate"), settings.get("slowMs"))
+            self._settings_key = (stat.st_ino, stat.st_mtime_ns)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            log("warning", "Could not read shared profiling settings", path=self.settings_file, error=e)
+
+    def configure(self, rate=None, slow_ms=None):
+        # Both are checked before either changes
+        rate = self.rate if rate is None else float(rate)
+        slow_ms = self.slow_ms if slow_ms is None else float(slow_ms)
+        if not 0 <= rate <= 1:
+            raise ValueError("rate must be between 0 and 1.")
+        if slow_ms < 0:
+            raise ValueError("slowMs can't be negative.")
+        self.rate, self.slow_ms = rate, slow_ms
+
+    def start(self, parse_seconds):
+        """A ProfileSample for a request about to be routed, or None to leave it alone."""
+        sampled = random.random() < self.rate
+        if not sampled and not self.slow_ms:
+            return None
+        return ProfileSample(parse_seconds, cProfile.Profile(), sampled)
+
+    def finish(self, sample, request, response):
+        sample.sent()
+        total_ms = sum(sample.phases.values()) * 1000
+        phases_ms = {phase: round(seconds * 1000, 3) for phase, seconds in sample.phases.items()}
+        slow = self.slow_ms and total_ms >= self.slow_ms
+        if slow:
+            log("warning", "Slow request", method=request.method, target=request.target, route=request.route,
+                status=response.status, duration_ms=round(total_ms, 3), phases_ms=phases_ms)
+        if sample.profile is None or not (sample.sampled or slow):
+            return
+        try:
+            self._save(sample.profile, request, response, total_ms, phases_ms)
+        except OSError as e:
+            log("error", "Error saving profile", error=e)
+
+    def _save(self, profile, request, response, total_ms, phases_ms):
+        route = re.sub(r"[^A-Za-z0-9]+", "_", request.route).strip("_") or "index"
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        name = f"{stamp}-{total_ms:.0f}ms-{request.method}-{route}"
+        os.makedirs(self.folder, exist_ok=True)
+        profile.dump_stats(os.path.join(self.folder, name + ".prof"))
+        with open(os.path.join(self.folder, name + ".json"), "w", encoding="utf-8") as f:
+            json.dump({"method": request.method, "target": request.target, "route": request.route,
+                       "status": response.status, "duration_ms": round(total_ms, 3), "phases_ms": phases_ms}, f)
+        with self._lock:
+            if self._saved is None:
+                self._saved = deque(sorted(entry[:-len(".prof")] for entry in os.listdir(self.folder)
+                                           if entry.endswith(".prof") and entry[:-len(".prof")] != name))
+            self._saved.append(name)
+            expired = [self._saved.popleft() for _ in range(len(self._saved) - self.keep)]
+        for old in expired:
+            for suffix in (".prof", ".json"):
+                try:
+                    os.unlink(os.path.join(self.folder, old + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def status(self):
+        with self._lock:
+            recent = list(self._saved or ())[-20:]
+        return {"rate": self.rate, "slowMs": self.slow_ms, "folder": os.path.abspath(self.folder),
+                "keep": self.keep, "recent": recent[::-1],
+                # Other workers apply a change within PROFILE_SYNC_INTERVAL; "recent" is this worker's
+                "sharedAcrossProcesses": self.settings_file is not None}
+
+
+PROFILER = Profiler()
+
 
 # --- Helper Functions ---
 
@@ -39,28 +392,81 @@ def get_last_change_time():
             with open(LAST_CHANGE_FILE, "r") as f:
                 return f.read().strip()
     except Exception as e:
-        print(f"Error reading last change file: {e}")
+        log("error", "Error reading last change file", error=e)
     return None # Return None if not found or error
 
 def update_last_change_time():
     """Writes the current timestamp to the last change file."""
     now_iso = datetime.now().isoformat()
     try:
-        with open(LAST_CHANGE_FILE, "w") as f:
-            f.write(now_iso)
+        write_atomic(LAST_CHANGE_FILE, now_iso) # Other worker processes may be reading it
         return now_iso
     except Exception as e:
-        print(f"Error writing last change file: {e}")
+        log("error", "Error writing last change file", error=e)
         return None # Indicate failure
 
+class HiddenPolicy:
+    """Decides which names in the shared tree are hidden from clients.
+
+    All globs and regular expressions are compiled into one regex, and
+    each name's verdict is memoized, so filtering a directory is one dict
+    lookup per entry once its names have been seen.
+    """
+
+    def __init__(self, globs=(), regexes=()):
+        self.globs = list(globs)
+        self.regexes = list(regexes)
+        self._compile()
+
+    def add(self, pattern):
+        """Hides names matching a glob, or a regex written as "re:<regex>"."""
+        if pattern.startswith("re:"):
+            re.compile(pattern[3:]) # Fail here, not on the next request
+            self.regexes.append(pattern[3:])
+        else:
+            self.globs.append(pattern)
+        self._compile()
+
+    def _compile(self):
+        parts = [fnmatch.translate(glob) for glob in self.globs] + [f"(?:{regex})" for regex in self.regexes]
+        self._matcher = re.compile("|".join(parts)) if parts else None
+        self._verdicts = {} # name -> hidden?, rebuilt whenever the patterns change
+
+    def is_hidden(self, name):
+        verdict = self._verdicts.get(name)
+        if verdict is None:
+            verdict = self._matcher is not None and self._matcher.fullmatch(name) is not None
+            if len(self._verdicts) >= HIDDEN_CACHE_SIZE:
+                self._verdicts = {} # Crude, but keeps memory bounded for huge trees
+            self._verdicts[name] = verdict
+        return verdict
+
+    def visible(self, names):
+        """The names that aren't hidden, in order: one pass over memoized verdicts."""
+        verdicts = self._verdicts
+        result = []
+        for name in names:
+            hidden = verdicts.get(name)
+            if hidden is None:
+                hidden = self.is_hidden(name)
+            if not hidden:
+                result.append(name)
+        return result
+
+    def is_hidden_path(self, rel_path):
+        """Whether any component of a relative path is hidden."""
+        return any(self.is_hidden(part) for part in rel_path.replace(os.sep, "/").split("/") if part)
+
+
+HIDDEN_POLICY = HiddenPolicy(HIDDEN_PATTERNS, HIDDEN_REGEXES)
+
 def is_hidden(filename):
-    """Checks if a filename matches any hidden patterns."""
-    if filename in HIDDEN_PATTERNS:
-        return True
-    if filename.startswith(".~lock"): # Handle specific patterns
-        return True
-    # Add more complex pattern matching (regex) if needed
-    return False
+    """Checks if a filename matches the hidden-file policy."""
+    return HIDDEN_POLICY.is_hidden(filename)
+
+def is_hidden_path(rel_path):
+    """Checks if a path below the shared folder is, or is inside, a hidden entry."""
+    return HIDDEN_POLICY.is_hidden_path(rel_path)
 
 def secure_path(base_folder, filename):
     """Constructs and validates a path within the base folder."""
@@ -85,239 +491,3452 @@ def secure_path(base_folder, filename):
     return full_path
 
 
-# --- Request Handler ---
+# --- Request / Response ---
+# The route functions below only see these two objects, so the same routes
+# are served by the threaded CustomHandler and by the asyncio engine.
 
-class CustomHandler(http.server.SimpleHTTPRequestHandler):
+class BodyReader:
+    """Blocking file-like reader over exactly Content-Length request bytes.
 
-    # Override SimpleHTTPRequestHandler methods slightly for API structure
+    `read_chunk(n)` is supplied by the engine and returns up to n bytes
+    from the connection. `remaining` tells the engine afterwards whether
+    the route left part of the body unread.
+    """
 
-    def send_json_response(self, status_code, data):
-        """Sends a JSON response."""
-        self.send_response(status_code)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+    def __init__(self, read_chunk, length):
+        self._read_chunk = read_chunk
+        self.length = length
+        self.remaining = length
+        self._buffer = b""
+        self.transfer = None # Set for shaped uploads, see BandwidthShaper
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        chunk = self._read_chunk(min(READ_CHUNK_SIZE, self.remaining))
+        if not chunk:
+            self.remaining = 0 # Client went away mid-body
+            return False
+        self.remaining -= len(chunk)
+        self._buffer += chunk
+        if self.transfer is not None:
+            # Not reading makes TCP slow the sender down to our rate
+            time.sleep(self.transfer.reserve(len(chunk)))
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self._buffer)
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
-    def send_error_response(self, status_code, message):
-        """Sends a JSON error response."""
-        self.send_json_response(status_code, {"success": False, "message": message})
+    def readline(self, size=-1):
+        while b"\n" not in self._buffer and (size < 0 or len(self._buffer) < size):
+            if not self._fill():
+                break
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
 
-    def do_GET(self):
-        """Handles GET requests for the main page, files, and API endpoints."""
+    @property
+    def exhausted(self):
+        return self.remaining <= 0 and not self._buffer
+
+
+def content_length(headers):
+    """The request's Content-Length (0 if absent); raises ValueError unless it is a plain non-negative number."""
+    value = headers.get('Content-Length')
+    if value is None:
+        return 0
+    value = value.strip()
+    if not value.isascii() or not value.isdigit(): # int() would also take "-5", "+5" and " 5_0"
+        raise ValueError(f"Invalid Content-Length: {value!r}")
+    return int(value)
+
+
+class Request:
+    """Engine-neutral view of one HTTP request."""
+
+    def __init__(self, method, target, headers, body, client_address):
+        self.method = method
+        self.target = target
+        self.path, _, self.query_string = target.partition('?')
+        self.query = parse_qs(self.query_string)
+        self.headers = headers # http.client.HTTPMessage, case-insensitive .get()
+        self.body = body # BodyReader
+        self.client_address = client_address
+        self.route = "other" # Route pattern for logs and metrics, set by dispatch
+
+
+class FileSegment:
+    """A byte range of an open file, sent by the engines with sendfile."""
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class Response:
+    """Status, headers and body returned by a route for the engine to send.
+
+    `body` is bytes, or a list of bytes and FileSegment pieces sent in
+    order. `file` is closed by the engine once the body is sent. Setting
+    `close` ends the connection afterwards.
+    """
+
+    def __init__(self, status, body=b"", content_type=None, headers=None, file=None):
+        self.status = status
+        self.body = body
+        self.headers = []
+        if content_type:
+            self.headers.append(("Content-type", content_type))
+        self.headers.extend(headers or [])
+        if isinstance(body, bytes):
+            self.length = len(body)
+        else:
+            self.length = sum(len(piece) for piece in body)
+        self.file = file
+        self.close = False
+        self.event_stream = None # Last-Event-ID string for text/event-stream responses
+        self.stream = None # Iterator of bytes sent instead of body, length unknown up front
+        self.shaped = False # Body counts as a download against the client's bandwidth share
+        self.transfer = None # Set by dispatch for shaped responses when shaping is on
+        self.chunked = False # Set by the engine: send `stream` with chunked transfer encoding
+        self.sent = 0 # Body bytes written so far, counted by the engine
+
+    def pieces(self):
+        return [self.body] if isinstance(self.body, bytes) else self.body
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.stream is not None and hasattr(self.stream, "close"):
+            self.stream.close() # Lets a generator clean up if the client went away
+        if self.transfer is not None:
+            self.transfer.finish()
+            self.transfer = None
+
+
+def encoded_response(body, content_type, encoding):
+    """A 200 response whose body is already in the given content coding."""
+    headers = [("Vary", "Accept-Encoding")]
+    if encoding != "identity":
+        headers.append(("Content-Encoding", encoding))
+    return Response(200, body, content_type, headers)
+
+def json_response(status_code, data):
+    """Builds a JSON response."""
+    return Response(status_code, json.dumps(data).encode('utf-8'), "application/json")
+
+def error_response(status_code, message):
+    """Builds a JSON error response."""
+    return json_response(status_code, {"success": False, "message": message})
+
+def error_page(status_code, message):
+    """Builds an HTML error page, like BaseHTTPRequestHandler.send_error."""
+    status = HTTPStatus(status_code)
+    html = http.server.DEFAULT_ERROR_MESSAGE % {
+        "code": status_code,
+        "message": message,
+        "explain": status.description,
+    }
+    response = Response(status_code, html.encode('utf-8', 'replace'),
+                        http.server.DEFAULT_ERROR_CONTENT_TYPE)
+    response.close = True
+    return response
+
+
+# --- Multipart Upload Parser ---
+
+class MultipartError(ValueError):
+    """Raised when a multipart/form-data body can't be parsed."""
+
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+
+    Feed it the request body in chunks of any size. At the start of each
+    part it calls `on_part(headers)`, which returns a sink with write(data),
+    close() and abort(), or None to skip the part. Part data is passed to
+    the sink as it arrives, so memory stays bounded by the chunk size plus
+    the boundary length no matter how large the files are.
+    """
+
+    MAX_HEADER_SIZE = 16 * 1024
+
+    def __init__(self, boundary, on_part):
+        self._delimiter = b"--" + boundary
+        self._part_end = b"\r\n" + self._delimiter
+        self._on_part = on_part
+        self._buffer = b""
+        self._state = "preamble"
+        self._sink = None
+        self.finished = False
+
+    def feed(self, data):
+        self._buffer += data
+        while self._step():
+            pass
+
+    def abort(self):
+        """Discards the part in progress (e.g. the client disconnected)."""
+        if self._sink is not None:
+            self._sink.abort()
+            self._sink = None
+
+    def _step(self):
+        """Advances the state machine once. Returns False when more data is needed."""
+        buffer = self._buffer
+        if self._state == "preamble":
+            index = buffer.find(self._delimiter)
+            if index < 0:
+                self._buffer = buffer[-len(self._delimiter):]
+                return False
+            self._buffer = buffer[index + len(self._delimiter):]
+            self._state = "delimiter"
+        elif self._state == "delimiter":
+            if len(buffer) < 2:
+                return False
+            if buffer.startswith(b"--"):
+                self._state = "epilogue"
+                self.finished = True
+            elif buffer.startswith(b"\r\n"):
+                self._buffer = buffer[2:]
+                self._state = "headers"
+            else:
+                raise MultipartError("bad boundary line")
+        elif self._state == "headers":
+            if buffer.startswith(b"\r\n"):
+                index, header_block = 0, b""
+            else:
+                index = buffer.find(b"\r\n\r\n")
+                if index < 0:
+                    if len(buffer) > self.MAX_HEADER_SIZE:
+                        raise MultipartError("part headers too large")
+                    return False
+                header_block = buffer[:index]
+                index += 2
+            self._buffer = buffer[index + 2:]
+            headers = HeaderParser().parsestr(header_block.decode('utf-8', 'replace'))
+            self._sink = self._on_part(headers)
+            self._state = "body"
+        elif self._state == "body":
+            index = buffer.find(self._part_end)
+            if index < 0:
+                # Hold back a possible partial delimiter, pass on the rest
+                keep = len(self._part_end) - 1
+                if len(buffer) > keep:
+                    self._write(buffer[:-keep])
+                    self._buffer = buffer[-keep:]
+                return False
+            self._write(buffer[:index])
+            self._buffer = buffer[index + len(self._part_end):]
+            if self._sink is not None:
+                self._sink.close()
+                self._sink = None
+            self._state = "delimiter"
+        else: # epilogue, ignored
+            self._buffer = b""
+            return False
+        return True
+
+    def _write(self, data):
+        if data and self._sink is not None:
+            self._sink.write(data)
+
+
+class UploadTarget:
+    """Multipart sink writing one uploaded file straight into its folder.
+
+    Data goes to a hidden temp file next to the destination and is hashed
+    on the way. Once the part is complete the file is filed in the blob
+    store and the destination linked to it, so readers never see a
+    half-written file and a repeated upload doesn't keep a second copy.
+    """
+
+    def __init__(self, filepath, display_name, uploaded, errors):
+        self.filepath = filepath
+        self.display_name = display_name
+        self.uploaded = uploaded
+        self.errors = errors
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=UPLOAD_TEMP_PREFIX)
+        os.fchmod(fd, 0o644)
+        self.file = os.fdopen(fd, 'wb')
+        self.digest = hashlib.sha256()
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
         try:
-            # API: Get Note
-            if self.path == '/api/note':
-                note_content = ""
-                if os.path.exists(NOTE_FILE):
-                    try:
-                        with open(NOTE_FILE, "r", encoding="utf-8") as f:
-                            note_content = f.read()
-                    except Exception as e:
-                        print(f"Error reading note file: {e}")
-                        # Don't send error to client, just return empty note maybe?
-                last_change = get_last_change_time()
-                self.send_json_response(200, {"note": note_content, "lastChange": last_change})
-
-            # API: Get File List
-            elif self.path == '/api/files':
-                files_list = []
-                try:
-                    for name in os.listdir(SHARED_FOLDER):
-                        if is_hidden(name):
-                            continue
-                        full_path = os.path.join(SHARED_FOLDER, name)
-                        if os.path.isfile(full_path): # Only list files
-                            files_list.append({
-                                "name": name,
-                                # URL encode filename for safe use in href
-                                "url": f"/shared/{quote(name)}"
-                            })
-                    files_list.sort(key=lambda x: x['name'].lower()) # Sort by name
-                    self.send_json_response(200, files_list)
-                except OSError as e:
-                    print(f"Error listing directory {SHARED_FOLDER}: {e}")
-                    self.send_error_response(500, "Could not list files.")
-
-            # Serve the main HTML template
-            elif self.path == '/':
-                 if os.path.exists(TEMPLATE_FILE):
-                     self.send_response(200)
-                     self.send_header("Content-type", "text/html; charset=UTF-8")
-                     # Prevent caching of the template itself during development
-                     self.send_header("Cache-Control", "no-cache, no-store, must-revalidate")
-                     self.send_header("Pragma", "no-cache")
-                     self.send_header("Expires", "0")
-                     self.end_headers()
-                     with open(TEMPLATE_FILE, 'rb') as f:
-                         self.wfile.write(f.read())
-                 else:
-                     self.send_error(404, f"{TEMPLATE_FILE} not found")
-
-            # Serve files from SHARED_FOLDER (e.g., /shared/myhomework.pdf)
-            elif self.path.startswith('/shared/'):
-                filename = self.path[len('/shared/'):]
+            self.file.write(data)
+            self.digest.update(data)
+        except OSError as e:
+            self._fail(e)
+
+    def close(self):
+        if self.failed:
+            return
+        try:
+            self.file.close()
+            BLOB_STORE.store(self.temp_path, self.digest.hexdigest(), self.filepath)
+            self.uploaded.append(self.display_name)
+            log("info", "Uploaded file saved", path=self.filepath)
+        except OSError as e:
+            self._fail(e)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+    def _fail(self, error):
+        log("error", "Error saving uploaded file", file=self.display_name, error=error)
+        self.errors.append(f"Failed to save '{self.display_name}'.")
+        self.failed = True
+        self.abort()
+
+
+# --- Blob Store ---
+
+class BlobStore:
+    """Content-addressed storage for the shared folder.
+
+    Each distinct file content is kept once, as .blobs/<aa>/<sha256>, and
+    every visible file with that content is a hardlink to it, so another
+    upload of a handout that is already shared only adds a directory
+    entry. Links share one inode and so one mtime; the time each later
+    link was made is kept in link-times.json and reported by link_mtime().
+    The store must be on the same filesystem as the shared folder; where
+    hardlinks aren't supported, files are stored as before.
+
+    A visible file edited in place changes its blob as well, so a blob is
+    re-hashed before it is reused unless it is unchanged since it was last
+    checked. Blobs no visible file links to any more are removed by
+    collect(), and are never linked to by hash alone (link_existing).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.link_times_path = os.path.join(folder, "link-times.json")
+        self.enabled = True
+        self._verified = {} # sha256 -> (inode, size, mtime_ns) when it last hashed correctly
+        self._link_times = {} # Path relative to the shared folder -> [inode, mtime_ns]
+        self._link_times_key = None # (inode, size, mtime_ns) of link-times.json when read
+        self._lock = threading.Lock()
+        self._times_lock = threading.Lock() # Listings needn't wait for a blob being hashed
+
+    def blob_path(self, sha256):
+        return os.path.join(self.folder, sha256[:2], sha256)
+
+    def lookup(self, sha256, size=None):
+        """Path of an intact blob with this hash (and size), or None."""
+        path = self.blob_path(sha256)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if size is not None and st.st_size != size:
+            return None
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if self._verified.get(sha256) != key:
+            if file_sha256(path) != sha256:
+                # Edited in place through one of its links; those files keep the new content
+                log("warning", "Blob was modified, removing it from the store", sha256=sha256)
+                os.unlink(path)
+                return None
+            self._verified[sha256] = key
+        return path
+
+    def store(self, temp_path, sha256, destination):
+        """Files a finished temp file under its hash and links `destination` to it.
+
+        The temp file is gone afterwards; if the content was already stored
+        its data is simply dropped.
+        """
+        if self.enabled:
+            try:
+                with self._lock:
+                    blob = self.lookup(sha256)
+                    if blob is None:
+                        blob = self.add_blob(temp_path, sha256)
+                    if not os.path.samefile(blob, temp_path): # Already stored: this is a new link
+                        self.link(blob, destination, time.time_ns())
+                    else:
+                        self.link(blob, destination)
+                os.unlink(temp_path)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EXDEV):
+                    raise
+                log("warning", "Hardlinks unavailable, storing uploads without deduplication", error=e)
+                self.enabled = False
+        os.replace(temp_path, destination)
+
+    def link_existing(self, sha256, size, destination):
+        """Links `destination` to stored content, if we have it. Returns True if so."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            blob = self.lookup(sha256, size)
+            # Only content some visible file still has: knowing the hash of a
+            # deleted file mustn't bring it back without its bytes being sent
+            if blob is None or os.stat(blob).st_nlink < 2:
+                return False
+            self.link(blob, destination, time.time_ns())
+            return True
+
+    def add_blob(self, path, sha256):
+        """Links `path` into the store as the blob for sha256 and returns the blob path."""
+        blob = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            # Another worker process (--processes) stored the same content since lookup()
+            blob = self.lookup(sha256)
+            if blob is None:
+                raise
+        return blob
+
+    def link(self, blob, destination, mtime_ns=None):
+        """Points `destination` at `blob`, atomically replacing any file there.
+
+        `mtime_ns` is recorded as the new file's own modification time
+        (otherwise it is the blob's).
+        """
+        temp_link = os.path.join(os.path.dirname(destination), f"{UPLOAD_TEMP_PREFIX}{uuid.uuid4().hex}")
+        os.link(blob, temp_link)
+        os.replace(temp_link, destination)
+        if os.path.lexists(temp_link): # rename() does nothing if both names are already the same file
+            os.unlink(temp_link)
+        if mtime_ns is not None:
+            self._update_link_times({self._relative(destination): [os.stat(destination).st_ino, mtime_ns]})
+
+    def link_mtime(self, path, stat):
+        """Modification time of a shared file, in seconds: its own if it is a later link to a blob."""
+        if stat.st_nlink < 2:
+            return stat.st_mtime
+        with self._times_lock:
+            self._read_link_times()
+            entry = self._link_times.get(self._relative(path))
+        if entry is None or entry[0] != stat.st_ino: # Replaced since, or not linked by us
+            return stat.st_mtime
+        return entry[1] / 1e9
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(self.folder)))
+
+    def _read_link_times(self):
+        # Caller holds self._times_lock; other worker processes may have written the file
+        try:
+            st = os.stat(self.link_times_path)
+        except FileNotFoundError:
+            self._link_times, self._link_times_key = {}, None
+            return
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if key != self._link_times_key:
+            try:
+                with open(self.link_times_path, 'r', encoding='utf-8') as f:
+                    self._link_times = json.load(f)
+            except (OSError, ValueError) as e:
+                log("warning", "Could not read link times", path=self.link_times_path, error=e)
+                self._link_times = {}
+            self._link_times_key = key
+
+    def _update_link_times(self, changes, keep=None):
+        """Merges `changes` into link-times.json; `keep(path, entry)` can drop stale entries."""
+        os.makedirs(self.folder, exist_ok=True)
+        with self._times_lock, file_lock(self.link_times_path + ".lock"):
+            self._read_link_times()
+            times = {path: entry for path, entry in self._link_times.items() if keep is None or keep(path, entry)}
+            times.update(changes)
+            write_atomic(self.link_times_path, json.dumps(times))
+            self._link_times, self._link_times_key = times, None
+
+    def dedupe_tree(self, root):
+        """Replaces duplicate files under root with links to one blob; returns bytes freed."""
+        freed = 0
+        for folder, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            for name in files:
+                path = os.path.join(folder, name)
+                if is_hidden(name) or os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                sha256 = file_sha256(path)
+                with self._lock:
+                    blob = self.lookup(sha256, st.st_size)
+                    if blob is None: # First copy of this content becomes the blob
+                        self.add_blob(path, sha256)
+                    elif not os.path.samefile(blob, path):
+                        self.link(blob, path, st.st_mtime_ns) # Keeps its own mtime
+                        if st.st_nlink == 1:
+                            freed += st.st_size
+        return freed
+
+    def collect(self):
+        """Removes blobs that no visible file links to any more; returns bytes freed."""
+        freed = 0
+        with self._lock:
+            if not os.path.isdir(self.folder):
+                return 0
+            for prefix in os.scandir(self.folder):
+                if not prefix.is_dir():
+                    continue
+                for entry in os.scandir(prefix.path):
+                    st = entry.stat()
+                    if st.st_nlink == 1:
+                        os.unlink(entry.path)
+                        self._verified.pop(entry.name, None)
+                        freed += st.st_size
+            if os.path.exists(self.link_times_path):
+                self._update_link_times({}, keep=self._is_current_link)
+        return freed
+
+    def _is_current_link(self, rel_path, entry):
+        path = os.path.join(os.path.dirname(self.folder), rel_path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False # Deleted or renamed
+        return st.st_ino == entry[0] and st.st_nlink > 1
+
+
+BLOB_STORE = BlobStore(os.path.join(SHARED_FOLDER, BLOB_FOLDER_NAME))
+
+
+# --- Upload Sessions ---
+# Resumable uploads: POST /api/uploads creates a session, PUT
+# /api/uploads/<id>?offset=N stores one chunk (several may be in flight at
+# once), GET reports which bytes are safely stored and POST
+# /api/uploads/<id>/finish verifies the file and moves it into place.
+
+class UploadOffsetConflict(Exception):
+    """A finish request for a session that still has missing bytes."""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}.")
+        self.offset = offset
+
+
+class UploadDigestMismatch(Exception):
+    """A chunk or file whose SHA-256 isn't the one the client sent."""
+
+    def __init__(self, expected, actual):
+        super().__init__(f"SHA-256 mismatch: expected {expected}, received data hashes to {actual}.")
+        self.expected = expected
+        self.actual = actual
+
+
+def add_range(ranges, start, end):
+    """Merges [start, end) into a sorted list of disjoint [start, end) ranges."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else: # Overlapping or touching
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_CHUNK_SIZE)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+
+class UploadSession:
+    """One resumable upload: a staging file in the shared folder and its state.
+
+    Chunks are written in place with os.pwrite and synced before their
+    range counts as received, so after a dropped connection or a server
+    restart the client resends only what is missing. Chunks may arrive in
+    any order and at the same time: each PUT is written by its own worker
+    thread and only the bookkeeping takes the lock. The received ranges
+    are kept in a small JSON file next to the staging file; that file is
+    the truth when --processes workers share a session, and is re-read
+    under an flock on the staging file before each update.
+    """
+
+    def __init__(self, folder, session_id, name, size, ranges=None):
+        self.id = session_id
+        self.name = name
+        self.size = size
+        self.ranges = ranges or [] # Received [start, end) byte ranges, sorted
+        self.chunks = [] # Timing of each chunk written since the session was created or loaded
+        self.created = time.perf_counter()
+        self.part_path = os.path.join(folder, f"{UPLOAD_TEMP_PREFIX}{session_id}.part")
+        self.state_path = os.path.join(folder, f"{UPLOAD_TEMP_PREFIX}{session_id}.json")
+        self.lock = threading.Lock() # Guards ranges, chunks and the state file
+
+    @property
+    def offset(self):
+        """Length of the received prefix; where a sequential client continues."""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def info(self):
+        return {"id": self.id, "name": self.name, "size": self.size,
+                "offset": self.offset, "received": self.ranges}
+
+    def load_state(self):
+        """Re-reads the state file, which another process may have updated; False if it's gone."""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.name, self.size, self.ranges = state["name"], state["size"], state["ranges"]
+        return True
+
+    def save_state(self):
+        # Not write_atomic: its temp name isn't hidden from the listing
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"name": self.name, "size": self.size, "ranges": self.ranges}, f)
+        os.replace(temp_path, self.state_path)
+
+    def write(self, offset, body, length, expected_sha256=None):
+        """Stores `length` bytes of `body` at `offset`; returns the chunk's stats.
+
+        Without expected_sha256, whatever arrives before the connection
+        drops is kept. With it, the chunk only counts if it arrived whole
+        and hashes to that value (UploadDigestMismatch otherwise).
+        """
+        if offset < 0 or offset + length > self.size:
+            raise ValueError("Chunk lies outside the declared file size.")
+        started = time.perf_counter()
+        write_seconds = 0.0
+        digest = hashlib.sha256()
+        position = offset
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            while position < offset + length:
+                data = body.read(min(READ_CHUNK_SIZE, offset + length - position))
+                if not data:
+                    break # Client went away
+                digest.update(data)
+                write_started = time.perf_counter()
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, position)
+                    view = view[written:]
+                    position += written
+                write_seconds += time.perf_counter() - write_started
+            write_started = time.perf_counter()
+            os.fsync(fd)
+            write_seconds += time.perf_counter() - write_started
+        finally:
+            os.close(fd)
+        if expected_sha256 is not None:
+            if position < offset + length:
+                raise ValueError("Chunk ended early.")
+            if digest.hexdigest() != expected_sha256:
+                raise UploadDigestMismatch(expected_sha256, digest.hexdigest())
+        finished = time.perf_counter()
+        # Wall-clock timings, so clients can tune chunk size and parallelism
+        chunk = {"offset": offset, "length": position - offset, "sha256": digest.hexdigest(),
+                 "startedAt": round(started - self.created, 4), "seconds": round(finished - started, 4),
+                 "writeSeconds": round(write_seconds, 4)}
+        with self.lock, file_lock(self.part_path, create=False):
+            if position > offset:
+                self.load_state() # Chunks may also arrive at other worker processes
+                self.ranges = add_range(self.ranges, offset, position)
+                self.save_state()
+            self.chunks.append(chunk)
+        return chunk
+
+    def finish(self, destination, expected_sha256=None):
+        """Checks the staging file and stores it as `destination`; returns its SHA-256.
+
+        If the whole file doesn't match expected_sha256 the received ranges
+        are cleared, since there's no telling which chunk was wrong.
+        """
+        with self.lock, file_lock(self.part_path, create=False):
+            self.load_state()
+            if self.offset != self.size:
+                raise UploadOffsetConflict(self.offset)
+            sha256 = file_sha256(self.part_path)
+            if expected_sha256 is not None and sha256 != expected_sha256:
+                self.ranges = []
+                self.save_state()
+                raise UploadDigestMismatch(expected_sha256, sha256)
+            BLOB_STORE.store(self.part_path, sha256, destination)
+            return sha256
+
+
+class UploadSessions:
+    """Open upload sessions by id, reloaded from disk after a restart."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, name, size):
+        self.purge_expired()
+        session = UploadSession(self.folder, uuid.uuid4().hex, name, size)
+        os.close(os.open(session.part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        session.save_state()
+        with self._lock:
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        """Returns the session or None if there is no such (unexpired) session."""
+        if len(session_id) != 32 or not all(c in "0123456789abcdef" for c in session_id):
+            return None # Ids also name files, so only accept what create() makes
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            session = UploadSession(self.folder, session_id, None, 0)
+            if not self._refresh(session):
+                return None
+            with self._lock:
+                return self._sessions.setdefault(session_id, session)
+        if not self._refresh(session): # Finished or cancelled by another process
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            return None
+        return session
+
+    def _refresh(self, session):
+        try:
+            return session.load_state() and os.path.exists(session.part_path)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def remove(self, session):
+        with self._lock:
+            self._sessions.pop(session.id, None)
+        for path in (session.part_path, session.state_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def purge_expired(self):
+        """Removes sessions nobody has written to for UPLOAD_SESSION_TTL seconds."""
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        with os.scandir(self.folder) as it:
+            stale = [entry.name[len(UPLOAD_TEMP_PREFIX):-len(".json")] for entry in it
+                     if entry.name.startswith(UPLOAD_TEMP_PREFIX) and entry.name.endswith(".json")
+                     and entry.stat().st_mtime < cutoff]
+        for session_id in stale:
+            session = self.get(session_id)
+            if session is not None:
+                log("info", "Removing expired upload session", session=session_id, file=session.name)
+                self.remove(session)
+
+
+UPLOAD_SESSIONS = UploadSessions(SHARED_FOLDER)
+
+
+# --- Compression ---
+
+COMPRESSORS = {
+    "gzip": lambda data: gzip.compress(data, 9, mtime=0),
+    "deflate": lambda data: zlib.compress(data, 9), # HTTP "deflate" is the zlib format
+}
+
+def choose_encoding(accept_encoding, available):
+    """Picks the content coding to use from `available` for an Accept-Encoding header.
+
+    Compressed codings win ties with identity; returns "identity" when the
+    client accepts none of them.
+    """
+    if not accept_encoding:
+        return "identity"
+    preferences = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
                 try:
-                    file_path = secure_path(SHARED_FOLDER, filename) # Validate path
-                    if os.path.isfile(file_path):
-                         # Use SimpleHTTPRequestHandler's file serving logic
-                         # We need to temporarily adjust 'path' for the base handler
-                         original_path = self.path
-                         # Map URL path to filesystem path relative to CWD for base handler
-                         self.path = os.path.relpath(file_path, os.getcwd())
-                         super().do_GET() # Let base class handle Range, HEAD, etc.
-                         self.path = original_path # Restore path
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        preferences[coding.strip().lower()] = quality
+    wildcard = preferences.get("*")
+    best, best_quality = "identity", preferences.get("identity", 1.0 if wildcard is None else wildcard)
+    for coding in available:
+        quality = preferences.get(coding, wildcard or 0.0)
+        if coding != "identity" and quality > 0 and (quality > best_quality or
+                                                     (quality == best_quality and best == "identity")):
+            best, best_quality = coding, quality
+    return best
+
+def variant_etag(etag, encoding):
+    """Each encoding of a resource needs its own strong ETag."""
+    if encoding == "identity":
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+class TemplateCache:
+    """The landing page held in memory with precompressed gzip/deflate variants.
+
+    The file is stat()ed at most every TEMPLATE_CHECK_INTERVAL seconds and
+    only re-read when its mtime or size changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None # (etag, mtime, {encoding: body})
+        self._key = None
+        self._checked = 0.0
+
+    def get(self):
+        """Returns (etag, mtime, variants); raises OSError if the file is missing."""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked >= TEMPLATE_CHECK_INTERVAL:
+            with self._lock:
+                if self._snapshot is None or now - self._checked >= TEMPLATE_CHECK_INTERVAL:
+                    self._refresh()
+                    self._checked = now
+        return self._snapshot
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._snapshot = self._key = None
+            raise
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key == self._key:
+            return
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        variants = {"identity": body}
+        for encoding, compress in COMPRESSORS.items():
+            variants[encoding] = compress(body)
+        self._snapshot = (file_etag(stat), stat.st_mtime, variants)
+        self._key = key
+        log("info", "Loaded template", path=self.path, size=len(body),
+            gzip=len(variants['gzip']), deflate=len(variants['deflate']))
+
+
+TEMPLATE_CACHE = TemplateCache(TEMPLATE_FILE)
+
+
+# Compressed API bodies by variant ETag, so e.g. an unchanged file listing
+# is compressed once rather than on every request.
+_compressed_bodies = OrderedDict()
+_compressed_bodies_lock = threading.Lock()
+COMPRESSED_BODIES_MAX = 64
+
+def compressed_body(variant_tag, body, encoding):
+    with _compressed_bodies_lock:
+        cached = _compressed_bodies.get(variant_tag)
+        if cached is not None:
+            _compressed_bodies.move_to_end(variant_tag)
+            return cached
+    cached = COMPRESSORS[encoding](body)
+    with _compressed_bodies_lock:
+        _compressed_bodies[variant_tag] = cached
+        while len(_compressed_bodies) > COMPRESSED_BODIES_MAX:
+            _compressed_bodies.popitem(last=False)
+    return cached
+
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/javascript", "application/xml",
+    "application/xhtml+xml", "image/svg+xml",
+}
+
+def is_compressible(content_type):
+    """Text-like types only; docx, pptx, pdf, png etc. are already compressed."""
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+class CompressionCache:
+    """Disk-backed cache of gzip/deflate copies of shared files.
+
+    Entries are keyed by (path, mtime, size), so a hot file is compressed
+    once and the copy is then served with sendfile like any other file.
+    Older copies of the same file are removed when a new one is written.
+    Names are hashes of the path, so copies of deleted or renamed files
+    can't be matched to their source; instead, once the folder is over
+    max_size the copies built longest ago are removed, whatever they are.
+    """
+
+    def __init__(self, folder, max_size=COMPRESSION_CACHE_MAX_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._building = {} # entry name -> Lock, so one thread compresses each entry
+
+    def _names(self, file_path, stat, encoding):
+        path_key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8', 'surrogateescape')).hexdigest()[:20]
+        version = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        return path_key, f"{path_key}-{version}.{encoding}"
+
+    def get(self, file_path, stat, encoding):
+        """Returns the path of the compressed copy, creating it if needed.
+
+        Returns None if the file changed since `stat` was taken.
+        """
+        path_key, name = self._names(file_path, stat, encoding)
+        cached_path = os.path.join(self.folder, name)
+        if os.path.exists(cached_path):
+            return cached_path
+        with self._lock:
+            build_lock = self._building.setdefault(name, threading.Lock())
+        with build_lock:
+            try:
+                if not os.path.exists(cached_path):
+                    if not self._build(file_path, stat, encoding, cached_path):
+                        return None
+                    self._prune(path_key, name, encoding)
+            finally:
+                with self._lock:
+                    self._building.pop(name, None)
+        return cached_path
+
+    def _build(self, file_path, stat, encoding, cached_path):
+        os.makedirs(self.folder, exist_ok=True)
+        with open(file_path, 'rb') as source:
+            current = os.fstat(source.fileno())
+            if (current.st_mtime_ns, current.st_size) != (stat.st_mtime_ns, stat.st_size):
+                return False
+            fd, temp_path = tempfile.mkstemp(dir=self.folder, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    if encoding == "gzip":
+                        compressor = zlib.compressobj(9, zlib.DEFLATED, 31) # gzip wrapper
                     else:
-                         self.send_error(404, "File not found")
-                except ValueError as e: # Path traversal or invalid
-                    print(f"Security Error serving file: {e}")
-                    self.send_error(403, "Forbidden")
+                        compressor = zlib.compressobj(9)
+                    while True:
+                        chunk = source.read(READ_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out.write(compressor.compress(chunk))
+                    out.write(compressor.flush())
+                os.replace(temp_path, cached_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        return True
+
+    def _prune(self, path_key, keep, encoding):
+        try:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.startswith(path_key) and entry.name.endswith("." + encoding) and entry.name != keep:
+                    os.unlink(entry.path)
+                elif entry.name != keep and not entry.name.startswith(".tmp-"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue # Pruned by another thread or process
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries) + os.path.getsize(os.path.join(self.folder, keep))
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
                 except FileNotFoundError:
-                     self.send_error(404, "File not found")
-                except Exception as e:
-                     print(f"Error serving file {filename}: {e}")
-                     self.send_error(500, "Server error serving file")
+                    pass
+                total -= size
+        except OSError as e:
+            log("error", "Error pruning compression cache", error=e)
+
+
+COMPRESSION_CACHE = CompressionCache(COMPRESSION_CACHE_FOLDER)
+
+
+# --- Conditional Requests ---
+
+def validator_headers(etag, mtime):
+    """ETag, Last-Modified and a Cache-Control that makes browsers revalidate."""
+    return [
+        ("ETag", etag),
+        ("Last-Modified", formatdate(mtime, usegmt=True)),
+        ("Cache-Control", "no-cache"),
+    ]
+
+def is_not_modified(request, etags, mtime):
+    """True if If-None-Match / If-Modified-Since show the client's copy is current.
+
+    `etags` is the ETag of the representation we would send, or a tuple of
+    the tags we might send (e.g. identity and compressed variants).
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if isinstance(etags, str):
+        etags = (etags,)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None: # Takes precedence over If-Modified-Since
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return any(tag.removeprefix("W/") in etags for tag in tags)
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def not_modified_response(etag, mtime):
+    return Response(304, b"", None, validator_headers(etag, mtime) + [("Vary", "Accept-Encoding")])
+
+def conditional_response(request, etag, mtime, build, compress=False):
+    """304 if the client's copy is current, else build() with validators added.
+
+    With `compress`, the body is also gzip/deflate encoded when the client
+    accepts it and the body is large enough to be worth it.
+    """
+    encoding = "identity"
+    if compress:
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'), COMPRESSORS)
+    candidates = (variant_etag(etag, encoding), etag)
+    if is_not_modified(request, candidates, mtime):
+        return not_modified_response(candidates[0], mtime)
+    response = build()
+    if response.status == 200:
+        if compress:
+            response.headers.append(("Vary", "Accept-Encoding"))
+            if encoding != "identity" and response.length >= COMPRESS_MIN_SIZE:
+                etag = variant_etag(etag, encoding)
+                response.body = compressed_body(etag, response.body, encoding)
+                response.length = len(response.body)
+                response.headers.append(("Content-Encoding", encoding))
+        response.headers.extend(validator_headers(etag, mtime))
+    return response
+
+
+# --- File Serving ---
 
-            # Fallback for other paths (or let base class handle if needed)
+def parse_range_header(value, size):
+    """Parses a `Range: bytes=...` header against a file of `size` bytes.
+
+    Returns a sorted list of (start, end) inclusive ranges with overlapping
+    ones merged, an empty list if none can be satisfied, or None if the
+    header is malformed or asks for too many ranges (serve the whole file).
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = part.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first == "": # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size - 1
             else:
-                 # self.send_error(404, "Resource not found")
-                 # Or maybe let base class handle for things like favicon.ico?
-                 super().do_GET() # Be careful with security implications
-
-        except ConnectionResetError:
-             print("Connection reset by peer during GET.")
-        except BrokenPipeError:
-             print("Broken pipe during GET.")
-        except Exception as e:
-            print(f"Unexpected error during GET {self.path}: {e}")
-            # Avoid sending detailed errors to client unless debugging
-            self.send_error(500, "Internal Server Error")
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def if_range_matches(if_range, etag, last_modified):
+    """True if If-Range still matches the file, so the Range applies."""
+    if if_range.startswith('W/'):
+        return False # Weak tags never match for ranges
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return parsedate_to_datetime(if_range) == parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        return False
+
+def file_etag(stat):
+    """Strong ETag for a file from its size and modification time."""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
 
+def file_response(request, file_path):
+    """Builds a 200, 206, 304 or 416 response for a file.
 
-    def do_POST(self):
-        """Handles POST requests for saving notes and uploading files."""
+    Conditional requests are answered from a stat() alone. Otherwise the
+    file is opened here and sent by the engine with sendfile; no file data
+    passes through Python buffers.
+    """
+    stat = os.stat(file_path)
+    ctype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    compressible = is_compressible(ctype) and stat.st_size >= COMPRESS_MIN_SIZE
+    encoding = "identity"
+    if compressible and not request.headers.get('Range'): # Ranges apply to the raw file
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'), COMPRESSORS)
+    etag = variant_etag(file_etag(stat), encoding)
+    mtime = BLOB_STORE.link_mtime(file_path, stat) # Links to stored content have their own
+    if is_not_modified(request, etag, mtime):
+        return not_modified_response(etag, mtime)
+
+    if encoding != "identity":
         try:
-            # API: Save Note
-            if self.path == '/api/note':
-                content_length = int(self.headers.get('Content-Length', 0))
-                if content_length == 0:
-                     return self.send_error_response(400, "No data received.")
+            cached_path = COMPRESSION_CACHE.get(file_path, stat, encoding)
+            if cached_path:
+                f = open(cached_path, 'rb')
+                headers = validator_headers(etag, mtime) + [
+                    ("Content-Encoding", encoding), ("Vary", "Accept-Encoding")]
+                return Response(200, [FileSegment(f, 0, os.fstat(f.fileno()).st_size)],
+                                ctype, headers, file=f)
+        except OSError as e:
+            log("error", "Error compressing file, sending it uncompressed", path=file_path, error=e)
+
+    f = open(file_path, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        etag = file_etag(stat)
+        mtime = BLOB_STORE.link_mtime(file_path, stat)
+        last_modified = formatdate(mtime, usegmt=True)
+        headers = validator_headers(etag, mtime) + [("Accept-Ranges", "bytes")]
+        if compressible:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        ranges = None
+        range_header = request.headers.get('Range')
+        if range_header:
+            if_range = request.headers.get('If-Range')
+            if if_range is None or if_range_matches(if_range, etag, last_modified):
+                ranges = parse_range_header(range_header, size)
+
+        if ranges is None:
+            return Response(200, [FileSegment(f, 0, size)], ctype, headers, file=f)
+        if not ranges:
+            f.close()
+            return Response(416, b"", None, [("Content-Range", f"bytes */{size}")])
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers.append(("Content-Range", f"bytes {start}-{end}/{size}"))
+            return Response(206, [FileSegment(f, start, end - start + 1)], ctype, headers, file=f)
+
+        # Several ranges: multipart/byteranges body
+        boundary = uuid.uuid4().hex
+        body = []
+        for start, end in ranges:
+            body.append((f"\r\n--{boundary}\r\n"
+                         f"Content-Type: {ctype}\r\n"
+                         f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode('latin-1'))
+            body.append(FileSegment(f, start, end - start + 1))
+        body.append(f"\r\n--{boundary}--\r\n".encode('latin-1'))
+        return Response(206, body, f"multipart/byteranges; boundary={boundary}", headers, file=f)
+    except Exception:
+        f.close()
+        raise
 
-                post_data_raw = self.rfile.read(content_length)
+def sendfile_segment(sock, segment):
+    """Sends a FileSegment with os.sendfile, falling back to socket.sendfile.
+
+    The socket may have a timeout (and so be non-blocking underneath), in
+    which case we wait for it to become writable between calls.
+    """
+    offset, remaining = segment.offset, segment.length
+    if hasattr(os, "sendfile"):
+        timeout = sock.gettimeout()
+        try:
+            while remaining > 0:
                 try:
-                    post_data = json.loads(post_data_raw.decode('utf-8'))
-                    note_content = post_data.get('note', '') # Default to empty string
-
-                    with open(NOTE_FILE, "w", encoding="utf-8") as f:
-                        f.write(note_content)
-
-                    last_change = update_last_change_time()
-                    print(f"Note saved to: {NOTE_FILE}")
-                    self.send_json_response(200, {"success": True, "message": "Note saved!", "lastChange": last_change})
-
-                except json.JSONDecodeError:
-                    self.send_error_response(400, "Invalid JSON data.")
-                except Exception as e:
-                    print(f"Error saving note: {e}")
-                    self.send_error_response(500, f"Could not save note: {e}")
-
-            # API: Upload Files
-            elif self.path == '/api/upload':
-                 ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
-                 if ctype == 'multipart/form-data':
-                     # Adjust boundary for FieldStorage if needed
-                     pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
-                     pdict['CONTENT-LENGTH'] = int(self.headers.get('content-length'))
-
-                     form = cgi.FieldStorage(
-                         fp=self.rfile,
-                         headers=self.headers,
-                         environ={'REQUEST_METHOD': 'POST',
-                                  'CONTENT_TYPE': self.headers['content-type'],
-                                  })
-
-                     uploaded_files = []
-                     errors = []
-                     # Handle multiple files sent with name 'files[]'
-                     if 'files[]' in form:
-                         file_items = form['files[]']
-                         # Ensure file_items is always a list
-                         if not isinstance(file_items, list):
-                             file_items = [file_items]
-
-                         for file_item in file_items:
-                             if file_item.filename:
-                                 try:
-                                     # Use secure_path to construct and validate
-                                     # Need basename again inside secure_path? Let secure_path handle it.
-                                     filename_only = os.path.basename(file_item.filename) # Sanitize again
-                                     filepath = secure_path(SHARED_FOLDER, filename_only)
-
-                                     with open(filepath, 'wb') as f:
-                                         shutil.copyfileobj(file_item.file, f)
-                                     uploaded_files.append(filename_only)
-                                     print(f"Uploaded file saved to: {filepath}")
-                                 except ValueError as e: # Security error from secure_path
-                                     print(f"Upload security error for {file_item.filename}: {e}")
-                                     errors.append(f"Blocked '{file_item.filename}': Invalid path.")
-                                 except Exception as e:
-                                     print(f"Error saving uploaded file {file_item.filename}: {e}")
-                                     errors.append(f"Failed to save '{file_item.filename}'.")
-                             else:
-                                 # This might happen if field is present but no file selected
-                                 print("Received 'files[]' field with no filename.")
-                         # After loop
-                         if uploaded_files:
-                             last_change = update_last_change_time()
-                             message = f"Successfully uploaded {len(uploaded_files)} file(s)."
-                             if errors: message += f" Encountered {len(errors)} error(s)."
-                             self.send_json_response(200, {
-                                 "success": True, # Partial success is still success overall
-                                 "message": message,
-                                 "uploaded": uploaded_files,
-                                 "errors": errors,
-                                 "lastChange": last_change
-                             })
-                         elif errors:
-                              self.send_error_response(400, f"Upload failed. Errors: {'; '.join(errors)}")
-                         else:
-                             self.send_error_response(400, "No valid files were uploaded.")
-
-                     else:
-                         self.send_error_response(400, "No 'files[]' field found in upload data.")
-                 else:
-                     self.send_error_response(400, "Invalid content type. Expected 'multipart/form-data'.")
-
-
-            # Unknown POST path
-            else:
-                self.send_error(404, "Endpoint not found")
+                    sent = os.sendfile(sock.fileno(), segment.file.fileno(), offset, remaining)
+                except BlockingIOError:
+                    if not select.select([], [sock], [], timeout)[1]:
+                        raise socket.timeout("timed out sending file")
+                    continue
+                if sent == 0:
+                    raise EOFError("file shrank while being sent")
+                offset += sent
+                remaining -= sent
+            return
+        except OSError as e:
+            if offset != segment.offset or isinstance(e, (BlockingIOError, ConnectionError, socket.timeout)):
+                raise
+            # e.g. sendfile unsupported for this file system: fall back below
+    sock.sendfile(segment.file, offset, remaining)
 
-        except ConnectionResetError:
-             print("Connection reset by peer during POST.")
-        except BrokenPipeError:
-             print("Broken pipe during POST.")
-        except Exception as e:
-            print(f"Unexpected error during POST {self.path}: {e}")
-            self.send_error_response(500, f"Server error processing request: {e}")
 
+# --- Bandwidth Shaping ---
 
-# --- Main execution ---
-if __name__ == "__main__":
-    # Ensure necessary files/folders exist
-    if not os.path.exists(SHARED_FOLDER): os.makedirs(SHARED_FOLDER)
-    if not os.path.exists(NOTE_FILE): open(NOTE_FILE, 'a').close() # Create if not exists
-    if not os.path.exists(LAST_CHANGE_FILE): update_last_change_time() # Create if not exists
+def parse_rate(text):
+    """Bytes per second from e.g. "500K", "2M" or "1.5G" (powers of 1024)."""
+    text = text.strip().upper().removesuffix("B").removesuffix("/S")
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(text[-1:], 1)
+    try:
+        rate = float(text[:-1] if scale > 1 else text) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a rate: {text!r} (use e.g. 500K or 2M)")
+    return int(rate)
 
-    # Allow address reuse (useful for quick restarts)
-    socketserver.TCPServer.allow_reuse_address = True
 
-    with socketserver.TCPServer(("", PORT), CustomHandler) as httpd:
-        print(f"Serving from http://localhost:{PORT}")
-        print(f"HTML Template: '{TEMPLATE_FILE}'")
-        print(f"Shared Folder: '{os.path.abspath(SHARED_FOLDER)}'")
-        print(f"Note File: '{os.path.abspath(NOTE_FILE)}'")
-        print(f"Last Change File: '{os.path.abspath(LAST_CHANGE_FILE)}'")
-        print("Press Ctrl+C to stop the server.")
+class Transfer:
+    """One shaped download or upload, paced at its current fair share."""
+
+    def __init__(self, shaper, client, direction):
+        self.shaper = shaper
+        self.client = client
+        self.direction = direction
+        self.allowance = 0.0
+        self.last = time.monotonic()
+
+    def reserve(self, size):
+        """Accounts `size` bytes; returns how long to wait before moving them."""
+        rate = self.shaper.account(self, size)
+        if rate is None:
+            return 0
+        now = time.monotonic()
+        self.allowance = min(self.allowance + (now - self.last) * rate, rate * SHAPING_BURST) - size
+        self.last = now
+        return max(0.0, -self.allowance / rate)
+
+    def finish(self):
+        self.shaper.finish(self)
+
+
+class BandwidthShaper:
+    """Token buckets per transfer, sized so that bandwidth is shared fairly.
+
+    Every active /shared/ (or ZIP) download and upload is a Transfer. Its
+    rate is an equal split of the global cap across all active transfers,
+    and of its client's cap across that client's transfers, whichever is
+    lower. So 40 phones fetching the same handout each get 1/40 of the
+    uplink instead of the first few taking it all, and one client opening
+    many connections doesn't get more than one client's share. Rates are
+    recomputed for every slice, so shares grow as transfers finish.
+
+    Waiting out a transfer's pace keeps whatever runs it busy: in the
+    threaded engine that is a pool worker for the whole transfer, so with
+    low limits a few slow downloads can occupy the pool (--workers). The
+    asyncio engine waits on the event loop instead, except for uploads,
+    which are read in an executor thread.
+
+    Usage per client is kept for /api/bandwidth until the client has been
+    idle for SHAPING_CLIENT_TTL.
+    """
+
+    def __init__(self, client_limit=0, global_limit=0):
+        self.client_limit = client_limit
+        self.global_limit = global_limit
+        self._lock = threading.Lock()
+        self._active = 0
+        self._clients = {} # ip -> usage dict
+        self._last_sweep = time.monotonic()
+
+    @property
+    def enabled(self):
+        return bool(self.client_limit or self.global_limit)
+
+    def start(self, client, direction):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= SHAPING_CLIENT_TTL / 10:
+                self._sweep(now)
+            usage = self._clients.get(client)
+            if usage is None:
+                usage = self._clients[client] = {"downloaded": 0, "uploaded": 0, "active": 0,
+                                                 "window_start": now, "window_bytes": 0, "rate": 0.0,
+                                                 "last_seen": now}
+            usage["active"] += 1
+            self._active += 1
+        return Transfer(self, client, direction)
+
+    def finish(self, transfer):
+        with self._lock:
+            usage = self._clients[transfer.client]
+            usage["active"] -= 1
+            usage["last_seen"] = time.monotonic()
+            self._active -= 1
+
+    def _sweep(self, now):
+        # Caller holds self._lock; clients with a transfer running are kept
+        self._clients = {ip: usage for ip, usage in self._clients.items()
+                         if usage["active"] or now - usage["last_seen"] < SHAPING_CLIENT_TTL}
+        self._last_sweep = now
+
+    def account(self, transfer, size):
+        """Records bytes moved and returns the transfer's current rate (None = unlimited)."""
+        now = time.monotonic()
+        with self._lock:
+            usage = self._clients[transfer.client]
+            usage[transfer.direction] += size
+            usage["window_bytes"] += size
+            if now - usage["window_start"] >= 1.0:
+                usage["rate"] = usage["window_bytes"] / (now - usage["window_start"])
+                usage["window_start"], usage["window_bytes"] = now, 0
+            rates = []
+            if self.global_limit:
+                rates.append(self.global_limit / self._active)
+            if self.client_limit:
+                rates.append(self.client_limit / usage["active"])
+        return min(rates) if rates else None
+
+    def report(self):
+        now = time.monotonic()
+        with self._lock:
+            clients = {ip: {"downloaded": usage["downloaded"], "uploaded": usage["uploaded"],
+                            "active": usage["active"],
+                            # A window that hasn't closed for a while means the client went quiet
+                            "bytesPerSecond": round(usage["rate"]) if now - usage["window_start"] < 2.0 else 0}
+                       for ip, usage in self._clients.items()}
+            return {"clientLimit": self.client_limit, "globalLimit": self.global_limit,
+                    "activeTransfers": self._active, "clients": clients}
+
+
+SHAPER = BandwidthShaper(CLIENT_RATE_LIMIT, GLOBAL_RATE_LIMIT)
+
+def segment_slices(segment, transfer):
+    """Yields (delay, piece) for sending a FileSegment at the transfer's pace."""
+    if transfer is None:
+        yield 0, segment
+        return
+    offset, end = segment.offset, segment.offset + segment.length
+    while offset < end:
+        length = min(SHAPING_SLICE, end - offset)
+        yield transfer.reserve(length), FileSegment(segment.file, offset, length)
+        offset += length
+
+
+# --- ZIP Archives ---
+
+class _ZipSink:
+    """Write-only, unseekable file for ZipFile, drained by zip_stream().
+
+    Without seek() ZipFile writes each member's sizes and CRC in a data
+    descriptor after its data, so nothing ever has to be rewritten and
+    the archive can go out as it is produced.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.pending = 0
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pending += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.pending = 0
+        return data
+
+
+def visible_files(root):
+    """(path, relative "/" path) of every visible file under root, in name order."""
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(HIDDEN_POLICY.visible(dirs))
+        for name in sorted(HIDDEN_POLICY.visible(files)):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                yield path, os.path.relpath(path, root).replace(os.sep, "/")
+
+def zip_stream(root):
+    """Yields a ZIP of the visible files under root, about READ_CHUNK_SIZE at a time.
+
+    No temp file: files are read, compressed and handed out block by
+    block, so memory stays flat apart from one small ZipInfo per member
+    for the central directory. Already-compressed types (docx, pptx, pdf,
+    png, ...) are stored as-is; ZipFile switches to ZIP64 by itself for
+    big members, big offsets or many entries.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for path, arcname in visible_files(root):
+            try:
+                src = open(path, "rb")
+            except OSError as e: # Deleted or unreadable since the walk
+                log("warning", "Skipping file in archive", path=path, error=e)
+                continue
+            with src:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                info.compress_type = zipfile.ZIP_DEFLATED if is_compressible(content_type) else zipfile.ZIP_STORED
+                with archive.open(info, "w") as member:
+                    while True:
+                        block = src.read(READ_CHUNK_SIZE)
+                        if not block:
+                            break
+                        member.write(block)
+                        if sink.pending >= READ_CHUNK_SIZE:
+                            yield sink.take()
+        # Closing writes the central directory into the sink
+    if sink.pending:
+        yield sink.take()
+
+
+# --- Previews ---
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DRAWING_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+def xml_snippet(stream, chars, ns):
+    """Text of one Office XML part, parsed while it is being inflated.
+
+    Stops as soon as `chars` characters are collected, so only the start
+    of a long document is ever decompressed. Returns (text, complete).
+    """
+    parser = ElementTree.XMLPullParser(("end",))
+    pieces = []
+    length = 0
+    inflated = 0
+    while length < chars:
+        block = stream.read(READ_CHUNK_SIZE)
+        inflated += len(block)
+        if not block or inflated > PREVIEW_MAX_XML_BYTES:
+            return "".join(pieces), not block
+        parser.feed(block)
+        for _, element in parser.read_events():
+            if element.tag == ns + "t":
+                piece = element.text or ""
+            elif element.tag == ns + "br":
+                piece = "\n"
+            elif element.tag == ns + "p":
+                piece = "\n"
+                element.clear() # Paragraph done, drop its runs
+            else:
+                continue
+            pieces.append(piece)
+            length += len(piece)
+    return "".join(pieces), False
+
+def office_snippet(path, chars):
+    """Start of the text of a docx (document body) or pptx (slides in order)."""
+    with zipfile.ZipFile(path) as archive:
+        if path.lower().endswith(".docx"):
+            parts, ns = ["word/document.xml"], WORD_NS
+        else:
+            prefix = "ppt/slides/slide"
+            numbers = sorted(int(name[len(prefix):-4]) for name in archive.namelist()
+                             if name.startswith(prefix) and name.endswith(".xml") and name[len(prefix):-4].isdigit())
+            parts, ns = [f"{prefix}{n}.xml" for n in numbers], DRAWING_NS
+        texts = []
+        length = 0
+        for part in parts:
+            with archive.open(part) as stream:
+                text, complete = xml_snippet(stream, chars - length, ns)
+            text = "\n".join(line for line in text.splitlines() if line.strip())
+            if text:
+                texts.append(text)
+                length += len(text) + 2
+            if not complete or length >= chars:
+                return "\n\n".join(texts), False
+    return "\n\n".join(texts), True
+
+def text_snippet(path, chars):
+    """Start of a text file: UTF-8 (with or without BOM) or UTF-16 with BOM."""
+    with open(path, "rb") as f:
+        data = f.read(chars * 4 + 3) # Enough for `chars` characters in any of those encodings
+        complete = not f.read(1)
+    encoding = "utf-16" if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) else "utf-8-sig"
+    # Not final, so a character cut off at the end of `data` is left out
+    text = codecs.getincrementaldecoder(encoding)("replace").decode(data)
+    return text, complete
+
+def has_text(path):
+    """Whether extract_snippet can read this kind of file."""
+    return path.lower().endswith((".docx", ".pptx")) or (mimetypes.guess_type(path)[0] or "").startswith("text/")
+
+def extract_snippet(path, chars):
+    """(text, complete) for a supported file; ValueError for anything else."""
+    if not has_text(path):
+        raise ValueError("Previews are available for text, docx and pptx files.")
+    if path.lower().endswith((".docx", ".pptx")):
+        try:
+            return office_snippet(path, chars)
+        except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+            raise ValueError(f"Not a readable Office document ({e}).")
+    return text_snippet(path, chars)
+
+
+class PreviewCache:
+    """LRU of extracted snippets keyed by (path, mtime, size), within a byte budget.
+
+    Each entry records whether the whole text was extracted, so a request
+    for more characters than were extracted before extracts again while
+    shorter requests are served from the cache.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self._entries = OrderedDict() # (path, mtime_ns, size) -> (text, complete)
+        self._keys = {} # path -> its current key, to drop outdated snippets
+        self._lock = threading.Lock()
+
+    def get(self, path, stat, chars):
+        """Returns (text of at most `chars` characters, truncated)."""
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        if cached is None or (not cached[1] and len(cached[0]) < chars):
+            cached = extract_snippet(path, chars)
+            self._put(key, cached)
+        text, complete = cached
+        return text[:chars], not complete or len(text) > chars
+
+    def _put(self, key, entry):
+        size = len(entry[0].encode("utf-8", "replace"))
+        if size > self.budget:
+            return
+        with self._lock:
+            old_key = self._keys.get(key[0])
+            if old_key in self._entries:
+                self._drop(old_key)
+            self._entries[key] = entry
+            self._keys[key[0]] = key
+            self.used += size
+            while self.used > self.budget:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        text, _ = self._entries.pop(key)
+        self.used -= len(text.encode("utf-8", "replace"))
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+
+
+PREVIEW_CACHE = PreviewCache(PREVIEW_CACHE_BYTES)
+
+
+# --- Search Index ---
+
+_WORD_RE = re.compile(r"[^\W_]+") # Letters and digits; "MLA_1" is "mla" and "1"
+
+def tokenize(text):
+    return [word for word in _WORD_RE.findall(text.lower()) if len(word) > 1 or word.isdigit()]
+
+
+class SearchIndex:
+    """Inverted index over the text of the shared documents, for /api/search.
+
+    Text comes from the /api/preview extractors and is saved with each
+    file's size and mtime in SEARCH_INDEX_FILE. Postings are rebuilt from
+    that at startup, which is cheap next to unzipping every document
+    again. The file is a log: a {"version"} line, then one line per
+    document indexed or deleted, so a save appends only what changed
+    (up to SEARCH_MAX_CHARS per document) rather than every document's
+    text; once most lines are superseded it is rewritten in one piece.
+    A background thread indexes files as uploads report them and,
+    at most every SEARCH_SYNC_INTERVAL seconds while people search, picks
+    up files added, changed or deleted by other means.
+    """
+
+    K1 = 1.2 # BM25 term-frequency saturation
+    B = 0.75 # BM25 length normalization
+    NAME_WEIGHT = 3 # Words in a file's path count this many times
+
+    def __init__(self, root, index_file):
+        self.root = root
+        self.index_file = index_file
+        self._docs = {} # relative path -> {"mtime_ns", "size", "text"}
+        self._lengths = {} # relative path -> number of terms
+        self._postings = {} # term -> {relative path: occurrences}
+        self._vocabulary = None # Sorted terms for prefix search, rebuilt after changes
+        self._unsaved = set() # Relative paths added or removed since the last save
+        self._records = None # Document lines in index_file, or None if it must be rewritten
+        self._lock = threading.Lock()
+        self._queue = queue.Queue() # Relative paths to (re)index, or None for a full sync
+        self._thread = None
+        self._last_sync = 0.0
+
+    def start(self):
+        """Loads the saved index and starts the indexer, which syncs with the tree first."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._load()
+            self._thread = threading.Thread(target=self._run, name="search-index", daemon=True)
+            self._thread.start()
+        self.request_sync()
+
+    def schedule(self, path):
+        """(Re)indexes a file soon, e.g. right after an upload."""
+        self.start()
+        self._queue.put(os.path.relpath(path, self.root).replace(os.sep, "/"))
+
+    def request_sync(self):
+        self._last_sync = time.monotonic()
+        self._queue.put(None)
+
+    def search(self, query, limit):
+        """Best BM25 matches for the words of query, as result dicts."""
+        self.start()
+        if time.monotonic() - self._last_sync > SEARCH_SYNC_INTERVAL:
+            self.request_sync() # Answer from the index as it is; this one is for next time
+        words = set(tokenize(query))
+        with self._lock:
+            if not words or not self._docs:
+                return []
+            if self._vocabulary is None:
+                self._vocabulary = sorted(self._postings)
+            average_length = sum(self._lengths.values()) / len(self._lengths) or 1
+            scores = Counter()
+            matched = {} # path -> query words found in it
+            for word in words:
+                for term in self._expand(word):
+                    postings = self._postings[term]
+                    idf = math.log(1 + (len(self._docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for path, count in postings.items():
+                        norm = self.K1 * (1 - self.B + self.B * self._lengths[path] / average_length)
+                        scores[path] += idf * count * (self.K1 + 1) / (count + norm)
+                        matched.setdefault(path, set()).add(word)
+            # Documents with more of the query words first, then by score
+            ranked = sorted(scores, key=lambda path: (len(matched[path]), scores[path]), reverse=True)
+            results = []
+            for path in ranked:
+                if not os.path.exists(os.path.join(self.root, path)):
+                    self._queue.put(path) # Deleted since the last sync
+                    continue
+                results.append({"path": path, "name": path.rsplit("/", 1)[-1], "url": f"/shared/{quote(path)}",
+                                "score": round(scores[path], 3), "snippet": self._snippet(self._docs[path]["text"], words)})
+                if len(results) == limit:
+                    break
+            return results
+
+    def _expand(self, word):
+        """Indexed terms matching a query word: the word itself, or longer words it starts."""
+        if len(word) < 3:
+            return [word] if word in self._postings else []
+        start = bisect.bisect_left(self._vocabulary, word)
+        end = bisect.bisect_left(self._vocabulary, word + "\uffff")
+        return self._vocabulary[start:end]
+
+    @staticmethod
+    def _snippet(text, words, width=160):
+        """The text around the first query word, whitespace collapsed."""
+        pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, sorted(words, key=len, reverse=True))) + ")", re.IGNORECASE)
+        found = pattern.search(text)
+        start = max(0, found.start() - width // 3) if found else 0
+        if start:
+            start = text.find(" ", start, found.start()) + 1 or start # Don't cut a word in half
+        snippet = " ".join(text[start:start + width].split())
+        return ("…" if start else "") + snippet + ("…" if start + width < len(text) else "")
+
+    def _run(self):
+        dirty = False
+        while True:
+            item = self._queue.get()
+            try:
+                dirty |= self._sync() if item is None else self._index(item)
+            except OSError as e:
+                log("error", "Error updating search index", error=e)
+            if dirty and self._queue.empty():
+                try:
+                    self._save()
+                    dirty = False
+                except OSError as e:
+                    log("error", "Error saving search index", error=e)
+
+    def _sync(self):
+        """Indexes new and changed files and drops deleted ones. Returns True on changes."""
+        current = {}
+        for path, rel_path in visible_files(self.root):
+            if has_text(path):
+                try:
+                    current[rel_path] = os.stat(path)
+                except OSError:
+                    pass
+        changed = False
+        for rel_path in set(self._docs) - set(current):
+            with self._lock:
+                self._remove(rel_path)
+            changed = True
+        for rel_path, stat in current.items():
+            doc = self._docs.get(rel_path)
+            if doc is None or (doc["mtime_ns"], doc["size"]) != (stat.st_mtime_ns, stat.st_size):
+                changed |= self._index(rel_path)
+        return changed
+
+    def _index(self, rel_path):
+        path = os.path.join(self.root, rel_path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or not has_text(path) or is_hidden_path(rel_path):
+            with self._lock:
+                return self._remove(rel_path)
+        try:
+            text, _ = extract_snippet(path, SEARCH_MAX_CHARS)
+        except ValueError as e: # Broken document: index its name only, don't retry until it changes
+            log("warning", "Could not index file", path=rel_path, error=e)
+            text = ""
+        with self._lock:
+            self._add(rel_path, {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "text": text})
+        return True
+
+    def _add(self, rel_path, doc):
+        self._remove(rel_path)
+        terms = Counter(tokenize(doc["text"]))
+        for word in tokenize(rel_path):
+            terms[word] += self.NAME_WEIGHT
+        self._docs[rel_path] = doc
+        self._unsaved.add(rel_path)
+        self._lengths[rel_path] = sum(terms.values())
+        for term, count in terms.items():
+            self._postings.setdefault(term, {})[rel_path] = count
+        self._vocabulary = None
+
+    def _remove(self, rel_path):
+        doc = self._docs.pop(rel_path, None)
+        if doc is None:
+            return False
+        self._unsaved.add(rel_path)
+        del self._lengths[rel_path]
+        for term in set(tokenize(doc["text"])) | set(tokenize(rel_path)):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(rel_path, None)
+                if not postings:
+                    del self._postings[term]
+        self._vocabulary = None
+        return True
+
+    def _load(self):
+        records = 0
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if "docs" in header:
+                    docs, records = header["docs"], None # Version 1, one object: rewrite as a log
+                else:
+                    docs = {}
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                            rel_path = record.pop("path")
+                        except (ValueError, KeyError):
+                            records = None # Torn write at the end; rewrite rather than append to it
+                            break
+                        if record.get("deleted"):
+                            docs.pop(rel_path, None)
+                        else:
+                            docs[rel_path] = record
+                        records += 1
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            log("warning", "Ignoring unreadable search index, rebuilding", path=self.index_file, error=e)
+            return
+        for rel_path, doc in docs.items():
+            self._add(rel_path, doc)
+        self._unsaved = set()
+        self._records = records
+
+    def _save(self):
+        """Appends the documents changed since the last save, or rewrites the file once it is mostly stale."""
+        with self._lock:
+            changed, self._unsaved = self._unsaved, set()
+            rewrite = self._records is None or \
+                self._records + len(changed) > max(SEARCH_COMPACT_MIN_RECORDS, 2 * len(self._docs))
+            if rewrite:
+                lines = [{"version": 2}] + [dict(doc, path=rel_path) for rel_path, doc in self._docs.items()]
+                records = len(self._docs)
+            else:
+                lines = [dict(self._docs[rel_path], path=rel_path) if rel_path in self._docs
+                         else {"path": rel_path, "deleted": True} for rel_path in changed]
+                records = self._records + len(lines)
+            data = "".join(json.dumps(line) + "\n" for line in lines)
+            self._records = None # Until the write below succeeds
+        # Only the indexer thread saves, so the write needs no lock
+        if rewrite:
+            write_atomic(self.index_file, data)
+        else:
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                f.write(data)
+        self._records = records
+
+
+SEARCH_INDEX = SearchIndex(SHARED_FOLDER, SEARCH_INDEX_FILE)
+
+
+# --- Tree Listing ---
+
+DIRECTORY_TYPE = "inode/directory"
+
+# Sort keys are tuples so a cursor can hold them and resume with bisect.
+# Size and mtime sort largest/newest first; names break ties.
+SORT_KEYS = {
+    "name": lambda e: (e["name"].lower(), e["name"]),
+    "size": lambda e: (-e["size"], e["name"].lower(), e["name"]),
+    "mtime": lambda e: (-e["mtime"], e["name"].lower(), e["name"]),
+}
+# What each element of a sort key is, to check keys coming back in cursors
+SORT_KEY_TYPES = {
+    "name": (str, str),
+    "size": ((int, float), str, str),
+    "mtime": ((int, float), str, str),
+}
+
+
+class TreeLister:
+    """Paginated, sorted walks of the shared tree for /api/files.
+
+    Each directory is scanned with os.scandir and its sorted listing cached
+    until the directory's mtime changes, so a page only touches the folders
+    it actually returns entries from. The walk is pre-order (a folder, then
+    its contents) and cursors record the sort key of the last entry at each
+    level, so pages stay consistent while files come and go. The flat list
+    of top-level files is served from the same cache (flat_files).
+    """
+
+    CACHE_SIZE = 256
+    # Directory mtimes this close to "now" might still change within the
+    # same timestamp tick, so they are not trusted (like git's racy index).
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, root):
+        self.root = root
+        self._cache = OrderedDict() # (rel_dir, sort) -> (mtime_ns, [(key, entry)])
+        self._lock = threading.Lock()
+        self._flat = (None, "", b"[]") # (listing it was built from, tag, body)
+
+    def listing(self, rel_dir, sort):
+        """Returns (mtime_ns, sorted [(key, entry)]) for one directory relative to the root."""
+        full_path = os.path.join(self.root, rel_dir)
+        mtime = os.stat(full_path).st_mtime_ns
+        cache_key = (rel_dir, sort)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None and cached[0] == mtime:
+                self._cache.move_to_end(cache_key)
+                return cached
+
+        items = []
+        with os.scandir(full_path) as it:
+            for entry in it:
+                if is_hidden(entry.name):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False) # Don't follow link loops
+                    if not is_dir and not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                info = {"name": entry.name, "path": rel_path, "mtime": BLOB_STORE.link_mtime(entry.path, stat)}
+                if is_dir:
+                    info.update(type=DIRECTORY_TYPE, size=0)
+                else:
+                    info.update(type=mimetypes.guess_type(entry.name)[0] or "application/octet-stream",
+                                size=stat.st_size, url=f"/shared/{quote(rel_path)}")
+                items.append((SORT_KEYS[sort](info), info))
+        items.sort(key=lambda item: item[0])
+
+        # Don't trust a directory mtime from the last moments
+        if time.time_ns() - mtime >= self.RACY_WINDOW_NS:
+            with self._lock:
+                self._cache[cache_key] = (mtime, items)
+                while len(self._cache) > self.CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return mtime, items
+
+    def flat_files(self):
+        """Returns (tag, body, mtime) of the top-level files as the flat JSON list.
+
+        The body is only re-encoded when the cached listing is rebuilt; the
+        tag is a hash of the body, so worker processes agree on it (for ETags).
+        """
+        mtime, items = self.listing("", "name")
+        built_from, tag, body = self._flat
+        if built_from is not items:
+            entries = [{"name": entry["name"], "url": entry["url"]}
+                       for _, entry in items if entry["type"] != DIRECTORY_TYPE]
+            body = json.dumps(entries).encode('utf-8')
+            tag = hashlib.sha1(body).hexdigest()[:16]
+            self._flat = (items, tag, body)
+        return tag, body, mtime / 1e9
+
+    def page(self, rel_dir, depth, sort, cursor, limit):
+        """Returns (entries, next_cursor, mtime) for up to `limit` entries of the walk.
+
+        `mtime` is the newest modification time of the folders walked and
+        the entries returned, in seconds.
+        """
+        # Stack frames are [rel_dir, items, next_index, level]
+        newest, items = self.listing(rel_dir, sort)
+        stack = [[rel_dir, items, 0, 0]]
+
+        def descend(path, level):
+            nonlocal newest
+            mtime, items = self.listing(path, sort)
+            newest = max(newest, mtime)
+            stack.append([path, items, 0, level])
+
+        for level, key in enumerate(cursor or []):
+            # Resume just after the key at this level, descending into it if
+            # it is a folder we were in the middle of (or had just listed)
+            frame = stack[-1]
+            index = bisect.bisect_right(frame[1], key, key=lambda item: item[0])
+            frame[2] = index
+            if index == 0 or frame[1][index - 1][0] != key or level >= depth:
+                break
+            entry = frame[1][index - 1][1]
+            if entry["type"] != DIRECTORY_TYPE:
+                break
+            descend(entry["path"], level + 1)
+
+        entries = []
+        while stack and len(entries) < limit:
+            frame = stack[-1]
+            _, items, index, level = frame
+            if index >= len(items):
+                stack.pop()
+                continue
+            frame[2] += 1
+            entry = items[index][1]
+            entries.append(entry)
+            if entry["type"] == DIRECTORY_TYPE and level < depth:
+                try:
+                    descend(entry["path"], level + 1)
+                except OSError:
+                    pass # Vanished or unreadable folder: list it, skip its contents
+
+        mtime = max([newest / 1e9] + [entry["mtime"] for entry in entries])
+        if not any(frame[2] < len(frame[1]) for frame in stack):
+            return entries, None, mtime
+        keys = [list(frame[1][frame[2] - 1][0]) for frame in stack if frame[2] > 0]
+        return entries, encode_cursor(sort, keys), mtime
+
+
+def encode_cursor(sort, keys):
+    data = json.dumps({"sort": sort, "keys": keys}, separators=(",", ":")).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip("=")
+
+def decode_cursor(cursor, sort):
+    """Returns the list of key tuples in a cursor; raises ValueError if invalid."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        keys = [tuple(key) for key in data["keys"]]
+    except Exception:
+        raise ValueError("Invalid cursor.")
+    if data.get("sort") != sort:
+        raise ValueError("Cursor was created for a different sort order.")
+    # Keys are compared with the listing's own, so they must have the same shape
+    types = SORT_KEY_TYPES[sort]
+    for key in keys:
+        if len(key) != len(types) or not all(isinstance(value, kind) and not isinstance(value, bool)
+                                              for value, kind in zip(key, types)):
+            raise ValueError("Invalid cursor.")
+    return keys
+
+
+SHARED_TREE = TreeLister(SHARED_FOLDER)
+
+
+# --- Note Store ---
+
+class NoteConflict(Exception):
+    """A save was based on an older version of the note."""
+
+    def __init__(self, version, text):
+        super().__init__(f"Note is at version {version}")
+        self.version = version
+        self.text = text
+
+
+def apply_delta(text, delta):
+    """Applies [[start, end, insert], ...] splices to text, in order.
+
+    Offsets count UTF-16 code units, which is what JavaScript string indices
+    in the browser use.
+    """
+    data = text.encode('utf-16-le')
+    for splice in delta:
+        start, end, insert = splice
+        if not (isinstance(start, int) and isinstance(end, int) and isinstance(insert, str)) \
+                or isinstance(start, bool) or isinstance(end, bool):
+            raise ValueError("Each delta entry must be [start, end, text].")
+        if not 0 <= start <= end <= len(data) // 2:
+            raise ValueError("Delta is out of range for the base version.")
+        data = data[:2 * start] + insert.encode('utf-16-le', 'surrogatepass') + data[2 * end:]
+    try:
+        return data.decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise ValueError("Delta splits a character.")
+
+
+class NoteStore:
+    """The shared note as a version number plus an append-only edit log.
+
+    The log's first line is a snapshot {"log", "base", "note"}; every save
+    appends one line, either {"v", "delta"} with the splices against the
+    previous version or {"v", "note"} for a full replacement, so a save
+    writes roughly the size of the edit. Every NOTE_COMPACT_OPS saves the
+    log is rewritten as a fresh snapshot (atomically, via rename) and
+    NOTE_FILE is refreshed as a plain-text copy.
+
+    Other processes (--processes workers) may write the log too: saves
+    hold an flock on <log>.lock, and the log is re-read whenever its inode
+    or size is not what this process last left it at.
+    """
+
+    def __init__(self, note_file, log_file):
+        self.note_file = note_file
+        self.log_file = log_file
+        self.lock_file = log_file + ".lock"
+        self._lock = threading.Lock()
+        self._loaded = None # (inode, size) of the log as last read or written here
+        self.log_id = None
+        self.version = 0
+        self.text = ""
+        self._ops = 0
+
+    def snapshot(self):
+        """Returns (log_id, version, text)."""
+        with self._lock:
+            if self._changed():
+                exists = os.path.exists(self.log_file) # If not, creating it is a write
+                with file_lock(self.lock_file, shared=exists): # No save in the middle of our read
+                    self._load(repair=not exists)
+            return self.log_id, self.version, self.text
+
+    def save(self, base_version, note=None, delta=None):
+        """Saves a full note or a delta; returns the new version.
+
+        Raises NoteConflict if base_version is given and isn't current, and
+        ValueError for a delta that doesn't apply.
+        """
+        with self._lock, file_lock(self.lock_file):
+            if self._changed():
+                self._load()
+            if base_version is not None and base_version != self.version:
+                raise NoteConflict(self.version, self.text)
+            if delta is not None:
+                text = apply_delta(self.text, delta)
+                record = {"v": self.version + 1, "delta": delta}
+            else:
+                text = note
+                record = {"v": self.version + 1, "note": note}
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            self.version += 1
+            self.text = text
+            self._ops += 1
+            if self._ops >= NOTE_COMPACT_OPS:
+                self._compact()
+            self._loaded = self._log_key()
+            return self.version
+
+    def _log_key(self):
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size
+
+    def _changed(self):
+        return self._loaded is None or self._log_key() != self._loaded
+
+    def _load(self, repair=True):
+        """Reads the log. `repair` (only with the exclusive lock) cuts off a torn last entry."""
+        if not os.path.exists(self.log_file):
+            # First run with a log: start from the plain note file
+            text = ""
+            if os.path.exists(self.note_file):
+                with open(self.note_file, "r", encoding="utf-8") as f:
+                    text = f.read()
+            self.log_id, self.version, self.text = uuid.uuid4().hex[:8], 1, text
+            self._compact()
+            self._loaded = self._log_key()
+            return
+
+        good_end = 0
+        with open(self.log_file, "rb") as f:
+            header = json.loads(f.readline())
+            good_end = f.tell()
+            self.log_id, self.version, self.text = header["log"], header["base"], header["note"]
+            self._ops = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if "delta" in record:
+                        self.text = apply_delta(self.text, record["delta"])
+                    else:
+                        self.text = record["note"]
+                    self.version = record["v"]
+                except (ValueError, KeyError):
+                    break # Torn write at the end of the log
+                good_end += len(line)
+                self._ops += 1
+        if good_end != os.path.getsize(self.log_file):
+            if not repair:
+                self._loaded = None # Repaired by the next save, before it appends
+                return
+            log("warning", "Discarding incomplete entry at the end of the note log", path=self.log_file)
+            os.truncate(self.log_file, good_end)
+        self._loaded = self._log_key()
+
+    def _compact(self):
+        header = {"log": self.log_id, "base": self.version, "note": self.text}
+        write_atomic(self.log_file, json.dumps(header) + "\n")
+        write_atomic(self.note_file, self.text)
+        self._ops = 0
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False, create=True):
+    """Holds an flock on `path` so worker processes take turns.
+
+    The file is created if missing, unless `create` is False (then
+    FileNotFoundError). Threads still need their own lock; without fcntl
+    this does nothing.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644) if create else os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd) # Releases the lock
+
+def write_atomic(path, text):
+    """Writes a text file via a temp file and rename, so readers never see half of it."""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".~tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+NOTE_STORE = NoteStore(NOTE_FILE, NOTE_LOG_FILE)
+
+
+# --- Change Feed ---
+
+class ChangeFeed:
+    """Server-Sent Events for /api/events: file list and note changes.
+
+    Listeners are callables taking encoded event bytes and returning False
+    once their client is gone; they must not block (the engines either
+    write to a non-blocking socket or hand off to an asyncio queue).
+
+    While anyone listens, a background thread checks the shared tree every
+    EVENTS_POLL_INTERVAL seconds (or at once after poke(), e.g. after an
+    upload) and publishes the added and removed files. Recent events are
+    kept so a reconnecting EventSource can catch up from Last-Event-ID.
+    The watcher also notices note saves made by other worker processes
+    (--processes); event ids are per process, so a client reconnecting to
+    another worker gets a reset.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = set()
+        self._backlog = deque(maxlen=EVENTS_BACKLOG) # (id number, encoded event)
+        self._next_id = 1
+        self._wake = threading.Event()
+        self._thread = None
+        self._files = None # path -> entry, as of the last check
+        self._poked = False
+        self._last_change = None # last_change.txt as of the last check
+        self._note = None # (log id, version) last published or seen
+
+    def publish(self, name, data):
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            message = (f"id: {BOOT_ID}-{event_id}\nevent: {name}\n"
+                       f"data: {json.dumps(data)}\n\n").encode('utf-8')
+            self._backlog.append((event_id, message))
+            self._send(message)
+            if name == "note":
+                self._note = (NOTE_STORE.log_id, data["version"])
+
+    @property
+    def subscribers(self):
+        return len(self._listeners)
+
+    def subscribe(self, listener, last_event_id=None):
+        """Registers a listener, first replaying what it missed since last_event_id."""
+        with self._lock:
+            backlog = self._missed_since(last_event_id)
+            if backlog is None: # Unknown or too old: the client must reload everything
+                backlog = f"event: reset\ndata: {json.dumps({'lastChange': get_last_change_time()})}\n\n".encode()
+            if listener(b"retry: 3000\n\n" + backlog):
+                self._listeners.add(listener)
+        self._start()
+        self._wake.set()
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+
+    def poke(self):
+        """Asks the watcher to check the shared folder now."""
+        self._poked = True
+        self._wake.set()
+
+    def _missed_since(self, last_event_id):
+        if not last_event_id:
+            return b""
+        boot, _, number = last_event_id.rpartition("-")
+        if boot != BOOT_ID or not number.isdigit():
+            return None
+        number = int(number)
+        if number >= self._next_id or (self._backlog and number < self._backlog[0][0] - 1):
+            return None
+        return b"".join(message for event_id, message in self._backlog if event_id > number)
+
+    def _send(self, message):
+        for listener in list(self._listeners):
+            if not listener(message):
+                self._listeners.discard(listener)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="change-feed", daemon=True)
+                self._thread.start()
+
+    def _watch(self):
+        last_heartbeat = time.monotonic()
+        while True:
+            self._wake.wait(EVENTS_POLL_INTERVAL if self._listeners else None)
+            self._wake.clear()
+            try:
+                self._check_files()
+                self._check_note()
+            except OSError as e:
+                log("error", "Error checking shared folder for changes", error=e)
+            if time.monotonic() - last_heartbeat >= EVENTS_HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                with self._lock:
+                    self._send(b": ping\n\n")
+
+    def _check_files(self):
+        poked, self._poked = self._poked, False
+        seen_change, self._last_change = self._last_change, get_last_change_time()
+        entries, _, _ = SHARED_TREE.page("", LISTING_MAX_DEPTH, "name", None, sys.maxsize)
+        files = {e["path"]: e for e in entries if e["type"] != DIRECTORY_TYPE}
+        previous, self._files = self._files, files
+        if previous is None:
+            return
+        added = [e for path, e in files.items()
+                 if path not in previous or (previous[path]["size"], previous[path]["mtime"]) != (e["size"], e["mtime"])]
+        removed = [path for path in previous if path not in files]
+        if added or removed:
+            # Uploads (here or at another worker process) already updated the
+            # change time; outside changes haven't
+            last_change = self._last_change
+            if not poked and last_change == seen_change:
+                last_change = self._last_change = update_last_change_time()
+            self.publish("files", {"lastChange": last_change, "added": added, "removed": removed})
+
+    def _check_note(self):
+        log_id, version, _ = NOTE_STORE.snapshot()
+        with self._lock:
+            previous, self._note = self._note, (log_id, version)
+        if previous is not None and previous != (log_id, version):
+            # Saved by another process; clients fetch the note themselves
+            self.publish("note", {"lastChange": get_last_change_time(), "version": version})
+
+
+CHANGE_FEED = ChangeFeed()
+
+
+# --- Routes ---
+
+def route_get_note(request):
+    """API: Get Note"""
+    last_change = get_last_change_time()
+    try:
+        log_id, version, note_content = NOTE_STORE.snapshot()
+    except Exception as e:
+        log("error", "Error reading note", error=e)
+        # Don't send error to client, just return empty note maybe?
+        log_id, version, note_content = "none", 0, ""
+    # Validators come from last_change.txt plus the note version
+    etag = '"note-' + hashlib.sha1(f"{last_change}|{log_id}|{version}".encode()).hexdigest()[:16] + '"'
+    try:
+        mtime = datetime.fromisoformat(last_change).timestamp()
+    except (TypeError, ValueError):
+        mtime = 0
+
+    def build():
+        return json_response(200, {"note": note_content, "version": version, "lastChange": last_change})
+    return conditional_response(request, etag, mtime, build, compress=True)
+
+def route_get_events(request):
+    """API: Server-Sent Events stream of file and note changes"""
+    response = Response(200, b"", "text/event-stream", [("Cache-Control", "no-cache")])
+    # EventSource sends Last-Event-ID when it reconnects
+    response.event_stream = request.headers.get('Last-Event-ID', "")
+    response.close = True # The stream ends when either side closes the connection
+    return response
+
+def route_get_files(request):
+    """API: Get File List
+
+    With any of path, depth, sort, limit or cursor it returns one page of a
+    sorted tree walk: {"path", "entries", "nextCursor"} (template.html walks
+    the whole tree this way). Without parameters it is the original flat
+    list of top-level files. Both come from SHARED_TREE's cached listings.
+    """
+    if any(name in request.query for name in ("path", "depth", "sort", "limit", "cursor")):
+        return list_tree_page(request) # Others, like a ?_= cache-buster, don't matter
+    try:
+        tag, body, mtime = SHARED_TREE.flat_files()
+        etag = f'"files-{tag}"'
+        return conditional_response(request, etag, mtime,
+                                    lambda: Response(200, body, "application/json"), compress=True)
+    except OSError as e:
+        log("error", "Error listing directory", path=SHARED_FOLDER, error=e)
+        return error_response(500, "Could not list files.")
+
+def list_tree_page(request):
+    def param(name, default=None):
+        return request.query.get(name, [default])[0]
+
+    rel_dir = param("path", "").strip("/")
+    sort = param("sort", "name")
+    try:
+        depth = min(int(param("depth", 0)), LISTING_MAX_DEPTH)
+        limit = max(1, min(int(param("limit", LISTING_PAGE_SIZE)), LISTING_MAX_PAGE_SIZE))
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key, use one of: {', '.join(SORT_KEYS)}.")
+        cursor = decode_cursor(param("cursor"), sort) if param("cursor") else None
+        if rel_dir:
+            if is_hidden_path(rel_dir):
+                return error_response(404, "Folder not found.")
+            folder = secure_path(SHARED_FOLDER, rel_dir)
+            rel_dir = os.path.relpath(folder, SHARED_FOLDER).replace(os.sep, "/")
+    except ValueError as e:
+        return error_response(400, str(e))
+    try:
+        entries, next_cursor, mtime = SHARED_TREE.page(rel_dir, max(depth, 0), sort, cursor, limit)
+    except (FileNotFoundError, NotADirectoryError):
+        return error_response(404, "Folder not found.")
+    except OSError as e:
+        log("error", "Error listing directory", path=rel_dir, error=e)
+        return error_response(500, "Could not list files.")
+    body = json.dumps({"path": rel_dir, "sort": sort, "depth": depth,
+                       "entries": entries, "nextCursor": next_cursor}).encode('utf-8')
+    etag = '"page-' + hashlib.sha1(body).hexdigest()[:16] + '"'
+    return conditional_response(request, etag, mtime,
+                                lambda: Response(200, body, "application/json"), compress=True)
+
+def route_get_zip(request):
+    """API: Download the shared folder, or ?path= a subfolder, as a ZIP"""
+    rel_dir = request.query.get("path", [""])[0].strip("/")
+    try:
+        if rel_dir and is_hidden_path(rel_dir):
+            return error_page(404, "Folder not found")
+        folder = secure_path(SHARED_FOLDER, rel_dir) if rel_dir else os.path.abspath(SHARED_FOLDER)
+    except ValueError as e:
+        log("warning", "Security error zipping folder", error=e)
+        return error_page(403, "Forbidden")
+    if not os.path.isdir(folder):
+        return error_page(404, "Folder not found")
+    name = (os.path.basename(folder) if rel_dir else "shared") + ".zip"
+    response = Response(200, b"", "application/zip", [
+        ("Content-Disposition", f"attachment; filename=\"{name.encode('ascii', 'replace').decode()}\"; "
+                                f"filename*=UTF-8''{quote(name)}"),
+        ("Cache-Control", "no-store"),
+    ])
+    response.stream = zip_stream(folder)
+    response.shaped = True
+    return response
+
+def route_get_preview(request):
+    """API: First characters of text in a shared file: ?path=...&chars=N"""
+    rel_path = request.query.get("path", [""])[0].strip("/")
+    try:
+        chars = max(1, min(int(request.query.get("chars", [PREVIEW_CHARS])[0]), PREVIEW_MAX_CHARS))
+    except ValueError:
+        return error_response(400, f"chars must be a whole number (default {PREVIEW_CHARS}, "
+                                   f"at most {PREVIEW_MAX_CHARS}).")
+    try:
+        if not rel_path or is_hidden_path(rel_path):
+            return error_response(404, "File not found.")
+        file_path = secure_path(SHARED_FOLDER, rel_path)
+        stat = os.stat(file_path)
+    except ValueError as e:
+        return error_response(400, str(e))
+    except OSError:
+        return error_response(404, "File not found.")
+    if not os.path.isfile(file_path):
+        return error_response(404, "File not found.")
+    etag = file_etag(stat)[:-1] + f'-p{chars}"'
+
+    def build():
+        try:
+            text, truncated = PREVIEW_CACHE.get(file_path, stat, chars)
+        except ValueError as e:
+            return error_response(415, str(e))
+        except OSError as e:
+            log("error", "Error previewing file", path=rel_path, error=e)
+            return error_response(500, "Could not read file.")
+        return json_response(200, {"path": rel_path, "text": text, "truncated": truncated})
+    return conditional_response(request, etag, stat.st_mtime, build, compress=True)
+
+def route_get_search(request):
+    """API: Search the text and names of shared documents: ?q=words&limit=N"""
+    query = request.query.get("q", [""])[0].strip()
+    if not tokenize(query):
+        return error_response(400, "Enter at least one word to search for.")
+    try:
+        limit = max(1, min(int(request.query.get("limit", [SEARCH_RESULTS])[0]), 100))
+    except ValueError:
+        return error_response(400, "limit must be a number.")
+    response = json_response(200, {"query": query, "results": SEARCH_INDEX.search(query, limit)})
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+def is_local_client(request):
+    return bool(request.client_address) and request.client_address[0] in ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+def route_get_bandwidth(request):
+    """API (local clients only): Bandwidth limits and what each client has used"""
+    if not is_local_client(request): # Lists every client's address
+        return error_response(403, "Bandwidth usage can only be viewed from the server itself.")
+    response = json_response(200, SHAPER.report())
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+def route_get_profiling(request):
+    """API (local clients only): Profiling settings and the newest saved profiles"""
+    if not is_local_client(request):
+        return error_response(403, "Profiling can only be managed from the server itself.")
+    response = json_response(200, PROFILER.status())
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+def route_post_profiling(request):
+    """API (local clients only): Change profiling: {"rate": 0.05, "slowMs": 500}, zeros turn it off"""
+    if not is_local_client(request):
+        return error_response(403, "Profiling can only be managed from the server itself.")
+    try:
+        settings = json.loads(request.body.read() or b"{}")
+        PROFILER.update(settings.get("rate"), settings.get("slowMs")) # Every worker process, with --processes
+    except (ValueError, TypeError, AttributeError) as e:
+        return error_response(400, f"Invalid profiling settings: {e}")
+    log("info", "Profiling changed", rate=PROFILER.rate, slow_ms=PROFILER.slow_ms)
+    return json_response(200, PROFILER.status())
+
+def route_get_metrics(request):
+    """API: Request and transfer metrics in Prometheus text format"""
+    response = Response(200, METRICS.render().encode('utf-8'), "text/plain; version=0.0.4; charset=utf-8")
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+def route_get_index(request):
+    """Serve the main HTML template"""
+    try:
+        etag, mtime, variants = TEMPLATE_CACHE.get()
+    except OSError:
+        return error_page(404, f"{TEMPLATE_FILE} not found")
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'), variants)
+    # Always revalidated (Cache-Control: no-cache), so template edits still show up at once
+    return conditional_response(request, variant_etag(etag, encoding), mtime,
+                                lambda: encoded_response(variants[encoding], "text/html; charset=UTF-8", encoding))
+
+def route_get_shared(request):
+    """Serve files from SHARED_FOLDER (e.g., /shared/myhomework.pdf)"""
+    filename = request.path[len('/shared/'):]
+    try:
+        file_path = secure_path(SHARED_FOLDER, filename) # Validate path
+        if is_hidden_path(os.path.relpath(file_path, SHARED_FOLDER)) or not os.path.isfile(file_path):
+            return error_page(404, "File not found") # Hidden files don't exist as far as clients know
+        response = file_response(request, file_path)
+        response.shaped = True
+        return response
+    except ValueError as e: # Path traversal or invalid
+        log("warning", "Security error serving file", error=e)
+        return error_page(403, "Forbidden")
+    except FileNotFoundError:
+        return error_page(404, "File not found")
+    except Exception as e:
+        log("error", "Error serving file", path=filename, error=e)
+        return error_page(500, "Server error serving file")
+
+def route_post_note(request):
+    """API: Save Note"""
+    content_length = request.body.length
+    if content_length == 0:
+        return error_response(400, "No data received.")
+
+    # Body is {"note": text} to replace the note, or {"baseVersion": n,
+    # "delta": [[start, end, text], ...]} to patch version n. With a
+    # baseVersion, saves based on an outdated version get a 409. An optional
+    # "clientId" is passed on in the change event so the saving page can
+    # recognise its own save.
+    post_data_raw = request.body.read(content_length)
+    try:
+        post_data = json.loads(post_data_raw.decode('utf-8'))
+        if not isinstance(post_data, dict):
+            return error_response(400, "Note data must be a JSON object.")
+        base_version = post_data.get('baseVersion')
+        if base_version is not None and (not isinstance(base_version, int) or isinstance(base_version, bool)):
+            return error_response(400, "baseVersion must be an integer.")
+        client_id = post_data.get('clientId')
+        if client_id is not None and (not isinstance(client_id, str) or len(client_id) > 64):
+            return error_response(400, "clientId must be a string of at most 64 characters.")
+        if 'delta' in post_data:
+            if base_version is None:
+                return error_response(400, "A delta needs a baseVersion.")
+            if not isinstance(post_data['delta'], list):
+                return error_response(400, "delta must be a list of [start, end, text] entries.")
+            version = NOTE_STORE.save(base_version, delta=post_data['delta'])
+        else:
+            note_content = post_data.get('note', '') # Default to empty string
+            if not isinstance(note_content, str):
+                return error_response(400, "Note must be a string.")
+            version = NOTE_STORE.save(base_version, note=note_content)
+
+        last_change = update_last_change_time()
+        log("info", "Note saved", path=NOTE_LOG_FILE, version=version)
+        event = {"lastChange": last_change, "version": version}
+        if client_id is not None:
+            event["clientId"] = client_id
+        if 'delta' in post_data: # Small edits travel with the event
+            event.update(baseVersion=base_version, delta=post_data['delta'])
+        CHANGE_FEED.publish("note", event)
+        return json_response(200, {"success": True, "message": "Note saved!",
+                                   "version": version, "lastChange": last_change})
+
+    except NoteConflict as e:
+        return json_response(409, {"success": False, "message": "The note was changed by someone else.",
+                                   "version": e.version, "note": e.text})
+    except json.JSONDecodeError:
+        return error_response(400, "Invalid JSON data.")
+    except (ValueError, TypeError) as e:
+        return error_response(400, f"Invalid note delta: {e}")
+    except Exception as e:
+        log("error", "Error saving note", error=e)
+        return error_response(500, f"Could not save note: {e}")
+
+def route_post_upload(request):
+    """API: Upload Files"""
+    ctype = Message()
+    ctype['Content-Type'] = request.headers.get('content-type', '')
+    boundary = ctype.get_param('boundary')
+    if ctype.get_content_type() != 'multipart/form-data' or not boundary:
+        return error_response(400, "Invalid content type. Expected 'multipart/form-data'.")
+
+    uploaded_files = []
+    errors = []
+    seen_field = False
+
+    def on_part(headers):
+        nonlocal seen_field
+        # Handle multiple files sent with name 'files[]'; other fields are skipped
+        if headers.get_param('name', header='content-disposition') != 'files[]':
+            return None
+        seen_field = True
+        filename = headers.get_filename()
+        if not filename:
+            # This might happen if field is present but no file selected
+            log("warning", "Received 'files[]' field with no filename")
+            return None
+        try:
+            # Use secure_path to construct and validate
+            filename_only = os.path.basename(filename) # Sanitize again
+            filepath = secure_path(SHARED_FOLDER, filename_only)
+        except ValueError as e: # Security error from secure_path
+            log("warning", "Upload security error", file=filename, error=e)
+            errors.append(f"Blocked '{filename}': Invalid path.")
+            return None
+        return UploadTarget(filepath, filename_only, uploaded_files, errors)
+
+    parser = MultipartParser(boundary.encode('latin-1'), on_part)
+    try:
+        while True:
+            chunk = request.body.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    except MultipartError as e:
+        parser.abort()
+        return error_response(400, f"Malformed upload data: {e}")
+    if not parser.finished:
+        parser.abort()
+        return error_response(400, "Upload was interrupted before it completed.")
+
+    if not seen_field:
+        return error_response(400, "No 'files[]' field found in upload data.")
+    if uploaded_files:
+        last_change = record_shared_change(*(os.path.join(SHARED_FOLDER, name) for name in uploaded_files))
+        message = f"Successfully uploaded {len(uploaded_files)} file(s)."
+        if errors: message += f" Encountered {len(errors)} error(s)."
+        return json_response(200, {
+            "success": True, # Partial success is still success overall
+            "message": message,
+            "uploaded": uploaded_files,
+            "errors": errors,
+            "lastChange": last_change
+        })
+    elif errors:
+        return error_response(400, f"Upload failed. Errors: {'; '.join(errors)}")
+    else:
+        return error_response(400, "No valid files were uploaded.")
+
+def parse_sha256(value):
+    """Validates an optional hex SHA-256 from a header or JSON body."""
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    if len(value) != 64 or not all(c in "0123456789abcdef" for c in value):
+        raise ValueError("SHA-256 must be 64 hex digits.")
+    return value
+
+def record_shared_change(*paths):
+    """After files were added: update the change time, change feed and search index."""
+    last_change = update_last_change_time()
+    CHANGE_FEED.poke()
+    for path in paths:
+        SEARCH_INDEX.schedule(path)
+    return last_change
+
+def route_post_upload_session(request):
+    """API: Start a resumable upload. Body is {"name": filename, "size": bytes}.
+
+    With "sha256" as well, content the server already stores is linked
+    into place at once and no session is needed ("deduplicated": true).
+    """
+    try:
+        post_data = json.loads(request.body.read().decode('utf-8'))
+        if not isinstance(post_data, dict):
+            return error_response(400, "Upload data must be a JSON object.")
+        filename_only = os.path.basename(str(post_data.get('name') or ''))
+        size = post_data.get('size')
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            raise ValueError("Size must be a non-negative number of bytes.")
+        if is_hidden(filename_only):
+            raise ValueError(f"{filename_only} is a reserved name.")
+        filepath = secure_path(SHARED_FOLDER, filename_only) # Validate now rather than at the end
+        sha256 = parse_sha256(post_data.get('sha256'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return error_response(400, "Invalid JSON data.")
+    except ValueError as e:
+        return error_response(400, f"Invalid upload: {e}")
+    try:
+        if sha256 and BLOB_STORE.link_existing(sha256, size, filepath):
+            log("info", "Uploaded file linked to existing content", path=filepath)
+            return json_response(200, {"success": True, "deduplicated": True, "sha256": sha256,
+                                       "message": f"{filename_only} is already on the server, nothing to send.",
+                                       "uploaded": [filename_only], "errors": [],
+                                       "lastChange": record_shared_change(filepath)})
+    except OSError as e:
+        log("error", "Error linking to stored content", file=filename_only, error=e) # Fall back to a normal upload
+    try:
+        session = UPLOAD_SESSIONS.create(filename_only, size)
+    except OSError as e:
+        log("error", "Error creating upload session", file=filename_only, error=e)
+        return error_response(500, "Could not start upload.")
+    log("info", "Upload session started", session=session.id, file=filename_only, size=size)
+    return json_response(201, dict(session.info(), chunkSize=UPLOAD_CHUNK_SIZE))
+
+def find_upload_session(request, suffix=""):
+    """The session named by /api/uploads/<id><suffix>, or None."""
+    session_id = request.path[len('/api/uploads/'):]
+    if suffix:
+        if not session_id.endswith(suffix):
+            return None
+        session_id = session_id[:-len(suffix)]
+    return UPLOAD_SESSIONS.get(session_id)
+
+def route_get_upload_session(request):
+    """API: Committed offset of an upload session, to resume from"""
+    session = find_upload_session(request)
+    if session is None:
+        return error_response(404, "Upload session not found.")
+    response = json_response(200, session.info())
+    response.headers.append(("Cache-Control", "no-store"))
+    return response
+
+def route_put_upload_chunk(request):
+    """API: Write the request body at ?offset=N of an upload session
+
+    An X-Chunk-SHA256 header makes the chunk count only if it matches.
+    """
+    session = find_upload_session(request)
+    if session is None:
+        return error_response(404, "Upload session not found.")
+    try:
+        offset = int(request.query.get('offset', [''])[0])
+        expected = parse_sha256(request.headers.get('X-Chunk-SHA256'))
+        chunk = session.write(offset, request.body, request.body.remaining, expected)
+    except UploadDigestMismatch as e:
+        return error_response(422, str(e))
+    except ValueError as e:
+        return error_response(400, f"Invalid chunk: {e}")
+    except OSError as e:
+        log("error", "Error writing upload session", session=session.id, error=e)
+        return error_response(500, "Could not store chunk.")
+    return json_response(200, {"success": True, "offset": session.offset, "received": session.ranges,
+                               "chunk": chunk})
+
+def route_post_upload_finish(request):
+    """API: Move a completely uploaded session's file into the shared folder
+
+    An optional body {"sha256": hex} is checked against the whole file.
+    """
+    session = find_upload_session(request, "/finish")
+    if session is None:
+        return error_response(404, "Upload session not found.")
+    try:
+        post_data_raw = request.body.read()
+        expected = parse_sha256(json.loads(post_data_raw.decode('utf-8')).get('sha256')) if post_data_raw else None
+    except (UnicodeDecodeError, AttributeError, ValueError) as e:
+        return error_response(400, f"Invalid finish request: {e}")
+    try:
+        filepath = secure_path(SHARED_FOLDER, session.name)
+        sha256 = session.finish(filepath, expected)
+    except UploadOffsetConflict as e:
+        return json_response(409, {"success": False, "message": f"Upload is incomplete ({e.offset} of {session.size} bytes).",
+                                   "offset": e.offset, "received": session.ranges})
+    except UploadDigestMismatch as e:
+        return error_response(422, f"{e} The upload must be sent again.")
+    except (ValueError, OSError) as e:
+        log("error", "Error finishing upload session", session=session.id, error=e)
+        return error_response(500, "Could not save uploaded file.")
+    UPLOAD_SESSIONS.remove(session)
+    log("info", "Uploaded file saved", path=filepath)
+    return json_response(200, {"success": True, "message": f"Successfully uploaded {session.name}.",
+                               "uploaded": [session.name], "errors": [], "lastChange": record_shared_change(filepath),
+                               "sha256": sha256, "chunks": sorted(session.chunks, key=lambda c: c["startedAt"])})
+
+def route_delete_upload_session(request):
+    """API: Abandon an upload session"""
+    session = find_upload_session(request)
+    if session is None:
+        return error_response(404, "Upload session not found.")
+    UPLOAD_SESSIONS.remove(session)
+    return json_response(200, {"success": True})
+
+
+# Exact-path routes, then prefix routes. HEAD is answered by the GET route.
+ROUTES = {
+    ("GET", "/"): route_get_index,
+    ("GET", "/api/note"): route_get_note,
+    ("GET", "/api/files"): route_get_files,
+    ("GET", "/api/events"): route_get_events,
+    ("GET", "/api/zip"): route_get_zip,
+    ("GET", "/api/preview"): route_get_preview,
+    ("GET", "/api/search"): route_get_search,
+    ("GET", "/api/bandwidth"): route_get_bandwidth,
+    ("GET", "/api/metrics"): route_get_metrics,
+    ("GET", "/api/profiling"): route_get_profiling,
+    ("POST", "/api/note"): route_post_note,
+    ("POST", "/api/upload"): route_post_upload,
+    ("POST", "/api/uploads"): route_post_upload_session,
+    ("POST", "/api/profiling"): route_post_profiling,
+}
+PREFIX_ROUTES = [
+    ("GET", "/shared/", route_get_shared),
+    ("GET", "/api/uploads/", route_get_upload_session),
+    ("PUT", "/api/uploads/", route_put_upload_chunk),
+    ("POST", "/api/uploads/", route_post_upload_finish),
+    ("DELETE", "/api/uploads/", route_delete_upload_session),
+]
+
+def find_route(method, path):
+    """Returns (pattern, handler): the matched path, or prefix + "*", and its route."""
+    if method == "HEAD":
+        method = "GET"
+    route = ROUTES.get((method, path))
+    if route is not None:
+        return path, route
+    for route_method, prefix, handler in PREFIX_ROUTES:
+        if route_method == method and path.startswith(prefix):
+            return prefix + "*", handler
+    return "other", None
+
+def is_shaped_upload(request):
+    return (request.method == "POST" and request.path == "/api/upload") or \
+           (request.method == "PUT" and request.path.startswith("/api/uploads/"))
+
+def dispatch(request):
+    """Runs the route for a request and always returns a Response."""
+    request.route, route = find_route(request.method, request.path)
+    if route is None:
+        if request.method != "GET":
+            return error_page(404, "Endpoint not found")
+        return error_page(404, "Resource not found")
+    client = request.client_address[0] if request.client_address else "-"
+    if SHAPER.enabled and is_shaped_upload(request):
+        request.body.transfer = SHAPER.start(client, "uploaded")
+    try:
+        response = route(request)
+    except TimeoutError: # The client stalled mid-body (socket timeout or _StreamBridge)
+        log("info", "Request body timed out", method=request.method, path=request.path, client=client)
+        response = error_response(408, "Timed out reading the request body")
+        response.close = True
+    except Exception as e:
+        log("error", "Unexpected error", method=request.method, path=request.path, error=e)
+        # Avoid sending detailed errors to client unless debugging
+        if request.method not in ("GET", "HEAD"): # API calls get JSON errors
+            response = error_response(500, f"Server error processing request: {e}")
+        else:
+            response = error_page(500, "Internal Server Error")
+        response.close = True # Response state is unknown, don't reuse
+    finally:
+        if request.body.transfer is not None:
+            request.body.transfer.finish()
+            request.body.transfer = None
+    if not request.body.exhausted:
+        response.close = True # Unread request body, the connection can't be reused
+    if SHAPER.enabled and response.shaped and request.method != "HEAD" and response.status in (200, 206):
+        response.transfer = SHAPER.start(client, "downloaded") # Finished by close_file
+    return response
+
+
+# --- Threaded engine ---
+
+class CustomHandler(http.server.BaseHTTPRequestHandler):
+
+    # Persistent connections: every response must carry a Content-Length
+    protocol_version = "HTTP/1.1"
+    # Drop idle keep-alive connections so they don't pin a pool worker forever;
+    # wait_for_request gives the worker up sooner when someone else needs it
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are separate writes; with Nagle the body waits for the
+    # client's delayed ACK (~40 ms per keep-alive request). asyncio sets this itself.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        METRICS.connection_opened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            METRICS.connection_closed()
+
+    def handle(self):
+        # BaseHTTPRequestHandler.handle, but kept-alive connections wait for
+        # their next request in wait_for_request rather than a blocking readline
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Waits for the next request on an idle connection; False to close it.
+
+        An idle connection still occupies a pool worker, so once it has been
+        idle for IDLE_RELEASE_AFTER it is closed if another connection is
+        waiting for a worker (the client simply reconnects next time),
+        instead of after the full timeout. Busy clients send their next
+        request well within that, so they don't race the close.
+        """
+        sock = self.connection
+        idle_since = time.monotonic()
+        deadline = idle_since + self.timeout
+        while True:
+            # Non-blocking peek: pipelined bytes already buffered, or newly arrived ones
+            sock.settimeout(0)
+            try:
+                if self.rfile.peek(1):
+                    return True
+            finally:
+                sock.settimeout(self.timeout)
+            now = time.monotonic()
+            if now >= deadline or (now - idle_since >= IDLE_RELEASE_AFTER and self.server.release_worker()):
+                return False
+            if select.select([sock], [], [], IDLE_POLL_INTERVAL)[0]:
+                sock.settimeout(0)
+                try:
+                    return bool(self.rfile.peek(1)) # Readable but nothing to peek: closed by the client
+                finally:
+                    sock.settimeout(self.timeout)
+
+    def parse_request(self):
+        self.parse_started = time.perf_counter() # The request line is in, headers are next
+        return super().parse_request()
+
+    def log_request(self, code="-", size="-"):
+        pass # record_request writes the access log once the response is sent
+
+    def log_message(self, format, *args):
+        # Malformed requests and other errors reported by BaseHTTPRequestHandler
+        log("warning", format % args, client=self.client_address[0])
+
+    def handle_route(self):
+        """Builds a Request, dispatches it and writes the Response."""
+        try:
+            length = content_length(self.headers)
+        except ValueError as e:
+            log("warning", "Bad request", client=self.client_address[0], method=self.command,
+                target=self.path, error=e)
+            response = error_page(400, "Invalid Content-Length")
+            response.close = True # The body can't be skipped without knowing its length
+            self.send_route_response(response)
+            return
+        started = time.perf_counter()
+        METRICS.request_started()
+        sample = PROFILER.start(started - self.parse_started) if PROFILER.active else None
+        body = BodyReader(self.rfile.read1, length)
+        request = Request(self.command, self.path, self.headers, body, self.client_address)
+        response = dispatch(request) if sample is None else sample.call(dispatch, request)
+        if response.stream is not None:
+            response.chunked = self.request_version == "HTTP/1.1"
+            if not response.chunked:
+                response.close = True # HTTP/1.0: the end of the body is the end of the connection
+        try:
+            self.send_route_response(response)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            log("info", "Client disconnected", client=self.client_address[0], method=self.command,
+                target=self.path, error=type(e).__name__)
+            self.close_connection = True
+        finally:
+            response.close_file()
+            record_request(request, response, started)
+            if sample is not None:
+                PROFILER.finish(sample, request, response)
+
+    def send_route_response(self, response):
+        self.send_response(response.status)
+        for keyword, value in response.headers:
+            self.send_header(keyword, value)
+        if response.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        elif response.status != 304 and response.event_stream is None and response.stream is None:
+            self.send_header("Content-Length", str(response.length))
+        if response.close:
+            self.send_header("Connection", "close") # Also sets close_connection
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if response.event_stream is not None:
+            self.start_event_stream(response.event_stream)
+            return
+        if response.stream is not None:
+            for data in response.stream:
+                if response.transfer is not None:
+                    time.sleep(response.transfer.reserve(len(data)))
+                response.sent += len(data)
+                if response.chunked:
+                    data = b"%x\r\n%b\r\n" % (len(data), data) if data else b""
+                self.wfile.write(data)
+            if response.chunked:
+                self.wfile.write(b"0\r\n\r\n")
+            return
+        for piece in response.pieces():
+            if isinstance(piece, FileSegment):
+                for delay, piece in segment_slices(piece, response.transfer):
+                    time.sleep(delay)
+                    sendfile_segment(self.connection, piece)
+                    response.sent += len(piece)
+            else:
+                self.wfile.write(piece)
+                response.sent += len(piece)
+
+    def start_event_stream(self, last_event_id):
+        """Hands this connection to the change feed and frees the worker.
+
+        The socket is switched to non-blocking and written by whichever
+        thread publishes an event; a client too slow to take a whole event
+        is dropped (EventSource reconnects and catches up).
+        """
+        sock = self.connection
+        self.server.detach(sock)
+        sock.setblocking(False)
+
+        def listener(data):
+            try:
+                if sock.send(data) == len(data):
+                    return True
+            except OSError:
+                pass
+            sock.close()
+            return False
+        CHANGE_FEED.subscribe(listener, last_event_id)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = handle_route
+
+
+# --- asyncio engine ---
+
+class _StreamBridge:
+    """Lets a route running in an executor thread read from an asyncio StreamReader."""
+
+    def __init__(self, reader, loop):
+        self._reader = reader
+        self._loop = loop
+
+    def read_chunk(self, size):
+        # Bounded like the threaded engine's socket timeout, so a client that
+        # stalls mid-body can't hold an executor thread forever
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self._reader.read(size), KEEPALIVE_TIMEOUT), self._loop)
+        try:
+            return future.result()
+        except asyncio.TimeoutError: # wait_for has already cancelled the read
+            raise TimeoutError("Timed out reading the request body") from None
+
+
+class AsyncServer:
+    """Serves the same routes as CustomHandler on asyncio streams.
+
+    Connections (including idle keep-alive ones) are coroutines rather than
+    threads; routes themselves run in `executor` because they do blocking
+    filesystem work.
+    """
+
+    server_version = "AsyncHTTP/0.1 Python/" + sys.version.split()[0]
+
+    def __init__(self, host, port, executor, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.executor = executor
+        self.reuse_port = reuse_port
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            reuse_address=True, reuse_port=self.reuse_port or None)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        METRICS.connection_opened()
+        try:
+            while await self.handle_one_request(reader, writer, client_address):
+                pass
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            log("error", "Unexpected error on connection", client=client_address, error=e)
+        finally:
+            writer.close()
+            METRICS.connection_closed()
+
+    async def handle_one_request(self, reader, writer, client_address):
+        """Reads, dispatches and answers one request. Returns True to keep the connection."""
+        loop = asyncio.get_running_loop()
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), ASYNC_KEEPALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return False
+        parse_started = time.perf_counter()
+
+        request_line, _, header_block = head.partition(b"\r\n")
+        try:
+            method, target, version = request_line.decode('iso-8859-1').split()
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+            length = content_length(headers)
+        except (ValueError, http.client.HTTPException):
+            log("warning", "Bad request syntax", client=client_address[0] if client_address else "-",
+                request_line=request_line.decode('iso-8859-1'))
+            await self.write_response(writer, "GET", error_page(400, "Bad request syntax"))
+            return False
+
+        connection = (headers.get('Connection') or "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+        started = time.perf_counter()
+        METRICS.request_started()
+        sample = PROFILER.start(started - parse_started) if PROFILER.active else None
+        body = BodyReader(_StreamBridge(reader, loop).read_chunk, length)
+        request = Request(method, target, headers, body, client_address)
+        if sample is None:
+            response = await loop.run_in_executor(self.executor, dispatch, request)
+        else: # The profiler follows the thread the route runs on
+            response = await loop.run_in_executor(self.executor, sample.call, dispatch, request)
+        if response.stream is not None:
+            response.chunked = version == "HTTP/1.1"
+            if not response.chunked:
+                response.close = True # HTTP/1.0: the end of the body is the end of the connection
+        if response.close or not keep_alive:
+            response.close = True
+        try:
+            await self.write_response(writer, method, response)
+        finally:
+            record_request(request, response, started)
+            if sample is not None: # Saving writes files, keep it off the event loop
+                await loop.run_in_executor(self.executor, PROFILER.finish, sample, request, response)
+        return not response.close
+
+    async def write_response(self, writer, method, response):
+        loop = asyncio.get_running_loop()
+        status = HTTPStatus(response.status)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+                 f"Server: {self.server_version}",
+                 f"Date: {formatdate(usegmt=True)}"]
+        lines.extend(f"{keyword}: {value}" for keyword, value in response.headers)
+        if response.chunked:
+            lines.append("Transfer-Encoding: chunked")
+        elif response.status != 304 and response.event_stream is None and response.stream is None:
+            lines.append(f"Content-Length: {response.length}")
+        if response.close:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1', 'strict'))
+        try:
+            if response.event_stream is not None and method != "HEAD":
+                await self.stream_events(writer, response.event_stream)
+            elif response.stream is not None and method != "HEAD":
+                # The stream does blocking file reads, so pull each block in the executor
+                while True:
+                    data = await loop.run_in_executor(self.executor, next, response.stream, None)
+                    if data is None:
+                        break
+                    if response.transfer is not None:
+                        await asyncio.sleep(response.transfer.reserve(len(data)))
+                    if data:
+                        response.sent += len(data)
+                        writer.write(b"%x\r\n%b\r\n" % (len(data), data) if response.chunked else data)
+                        await writer.drain()
+                if response.chunked:
+                    writer.write(b"0\r\n\r\n")
+            elif method != "HEAD":
+                for piece in response.pieces():
+                    if isinstance(piece, FileSegment):
+                        # loop.sendfile uses os.sendfile and falls back to read/write itself
+                        await writer.drain()
+                        for delay, piece in segment_slices(piece, response.transfer):
+                            await asyncio.sleep(delay)
+                            await loop.sendfile(writer.transport, piece.file, piece.offset, piece.length)
+                            response.sent += len(piece)
+                    else:
+                        writer.write(piece)
+                        response.sent += len(piece)
+            await writer.drain()
+        finally:
+            response.close_file()
+
+    async def stream_events(self, writer, last_event_id):
+        """Relays change feed events to one client until it disconnects."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def listener(data): # Called from other threads
+            if loop.is_closed() or queue.qsize() > EVENTS_BACKLOG:
+                return False # Client isn't keeping up
+            loop.call_soon_threadsafe(queue.put_nowait, data)
+            return True
+        CHANGE_FEED.subscribe(listener, last_event_id)
+        try:
+            while True:
+                writer.write(await queue.get())
+                await asyncio.wait_for(writer.drain(), EVENTS_HEARTBEAT_INTERVAL * 2)
+        finally:
+            CHANGE_FEED.unsubscribe(listener)
+
+
+# --- Servers ---
+
+class ThreadPoolMixIn:
+    """Mix-in that hands each accepted connection to a fixed-size worker pool.
+
+    Unlike socketserver.ThreadingMixIn this never starts more than
+    `pool_size` threads; extra connections wait in the pool's queue.
+    """
+    pool_size = WORKER_POOL_SIZE
+    daemon_threads = True
+    _waiting = 0 # Connections accepted but not yet picked up by a worker
+    _releasing = 0 # Idle connections closing to make way for them
+
+    def process_request(self, request, client_address):
+        if getattr(self, "_pool", None) is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.pool_size,
+                                            thread_name_prefix="worker")
+            self._waiting_lock = threading.Lock()
+        with self._waiting_lock:
+            self._waiting += 1
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def release_worker(self):
+        """True if an idle connection should close: a queued one needs its worker.
+
+        Each queued connection is claimed by one idle connection only, so
+        a single newcomer doesn't close every idle keep-alive connection.
+        """
+        with self._waiting_lock:
+            if self._waiting > self._releasing:
+                self._releasing += 1
+                return True
+            return False
+
+    def process_request_thread(self, request, client_address):
+        """Same as ThreadingMixIn: run the handler, then always close."""
+        with self._waiting_lock:
+            self._waiting -= 1
+            self._releasing = max(0, self._releasing - 1)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if getattr(self, "_pool", None) is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class DetachMixIn:
+    """Lets a handler keep its socket open after the request (event streams)."""
+
+    def __init__(self, *args, **kwargs):
+        self._detached = set() # Made here: handlers detach from several worker threads at once
+        self._detached_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def detach(self, request):
+        with self._detached_lock:
+            self._detached.add(request)
+
+    def shutdown_request(self, request):
+        with self._detached_lock:
+            if request in self._detached:
+                self._detached.discard(request) # Now owned by whoever detached it
+                return
+        super().shutdown_request(request)
+
+
+class ReusePortMixIn:
+    """Lets several processes listen on the same port (--processes)."""
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class SingleServer(DetachMixIn, ReusePortMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def release_worker(self):
+        # Anyone waiting is still in the listen backlog
+        return bool(select.select([self.socket], [], [], 0)[0])
+
+
+class ThreadPoolServer(DetachMixIn, ReusePortMixIn, ThreadPoolMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def run_supervisor(processes):
+    """Forks `processes` workers and restarts any that die; returns (the slot number) only in a worker.
+
+    Each worker binds PORT itself with SO_REUSEPORT and the kernel spreads
+    new connections between them. This runs before any threads exist, so
+    workers start from a clean copy of the process. Shared state lives in
+    files: the note log and upload sessions (under flock), last_change.txt
+    and the shared folder itself.
+    """
+    workers = {} # pid -> slot
+    started = {} # slot -> when it was last started, to slow down a crash loop
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            return True
+        workers[pid] = slot
+        started[slot] = time.monotonic()
+        log("info", "Worker started", pid=pid, slot=slot)
+        return False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for slot in range(processes):
+        if spawn(slot):
+            return slot
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = workers.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        log("warning", "Worker exited, restarting it", pid=pid, slot=slot,
+            exit_code=os.waitstatus_to_exitcode(status))
+        if time.monotonic() - started[slot] < 10 * WORKER_RESTART_DELAY:
+            time.sleep(WORKER_RESTART_DELAY) # It died soon after starting: don't spin
+        if spawn(slot):
+            return slot
+    print("\nServer stopping.")
+    sys.exit(0)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Classroom file and note sharing server.")
+    parser.add_argument("port", nargs="?", type=int, default=PORT,
+                        help=f"Port to listen on (default {PORT}).")
+    parser.add_argument("--workers", type=int, default=WORKER_POOL_SIZE,
+                        help=f"Size of the worker thread pool (default {WORKER_POOL_SIZE}).")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="Serving engine: worker-pool threads or asyncio streams.")
+    parser.add_argument("--single", action="store_true",
+                        help="Serve one request at a time (no worker pool).")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Worker processes sharing the port with SO_REUSEPORT, restarted if they die (default 1).")
+    parser.add_argument("--hide", action="append", default=[], metavar="PATTERN",
+                        help="Also hide files matching this glob, or 're:<regex>' (repeatable).")
+    parser.add_argument("--client-limit", type=parse_rate, default=CLIENT_RATE_LIMIT, metavar="RATE",
+                        help="Per-client download and upload limit in bytes/s, e.g. 1M (default unlimited).")
+    parser.add_argument("--global-limit", type=parse_rate, default=GLOBAL_RATE_LIMIT, metavar="RATE",
+                        help="Total limit shared fairly by all transfers, e.g. 4M (default unlimited).")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Replace duplicate files in the shared folder with links to one copy, then exit.")
+    return parser.parse_args(argv)
+
+
+# --- Main execution ---
+if __name__ == "__main__":
+    args = parse_args()
+    PORT = args.port
+    for pattern in args.hide:
+        try:
+            HIDDEN_POLICY.add(pattern)
+        except re.error as e:
+            sys.exit(f"Invalid --hide pattern {pattern!r}: {e}")
+    SHAPER.client_limit = args.client_limit
+    PROFILER.folder = os.environ.get("SERVER_PROFILE_DIR", PROFILER.folder)
+    try:
+        PROFILER.configure(os.environ.get("SERVER_PROFILE_RATE"), os.environ.get("SERVER_PROFILE_SLOW_MS"))
+    except ValueError as e:
+        sys.exit(f"Invalid SERVER_PROFILE_RATE or SERVER_PROFILE_SLOW_MS: {e}")
+    SHAPER.global_limit = args.global_limit
+
+    # Ensure necessary files/folders exist
+    if not os.path.exists(SHARED_FOLDER): os.makedirs(SHARED_FOLDER)
+    if not os.path.exists(NOTE_FILE): open(NOTE_FILE, 'a').close() # Create if not exists
+    NOTE_STORE.snapshot() # Load (or create) the note log
+    if not os.path.exists(LAST_CHANGE_FILE): update_last_change_time() # Create if not exists
+    if args.dedupe:
+        freed = BLOB_STORE.dedupe_tree(SHARED_FOLDER)
+        print(f"Deduplicated '{os.path.abspath(SHARED_FOLDER)}': {freed} bytes freed.")
+        sys.exit(0)
+    freed = BLOB_STORE.collect() # Content whose files were all deleted or replaced
+    if freed:
+        log("info", "Removed unreferenced blobs", bytes_freed=freed)
+
+    worker_slot = 0
+    reuse_port = args.processes > 1
+    if reuse_port:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT") or fcntl is None:
+            sys.exit("--processes needs fork, SO_REUSEPORT and fcntl (Linux, BSD or macOS).")
+        SHAPER.global_limit //= args.processes # Each worker shapes its own transfers
+        PROFILER.settings_file = PROFILE_SETTINGS_FILE
+        PROFILER.share() # Start from this run's settings, not the last run's
+        worker_slot = run_supervisor(args.processes)
+        BOOT_ID = uuid.uuid4().hex[:8] # Per process: event ids count this process's events
+        random.seed()
+    SEARCH_INDEX.start() # Load the saved index and catch up with the shared folder in the background
+    try:
+        TEMPLATE_CACHE.get() # Preload the landing page and its compressed variants
+    except OSError as e:
+        log("warning", "Could not load template", path=TEMPLATE_FILE, error=e)
+
+    # Allow address reuse (useful for quick restarts)
+    socketserver.TCPServer.allow_reuse_address = True
+
+    def print_banner(mode):
+        if worker_slot: # Worker 0 speaks for all of them
+            return
+        if reuse_port:
+            mode += f", {args.processes} processes"
+        print(f"Serving from http://localhost:{PORT} ({mode})")
+        print(f"HTML Template: '{TEMPLATE_FILE}'")
+        print(f"Shared Folder: '{os.path.abspath(SHARED_FOLDER)}'")
+        print(f"Note Log: '{os.path.abspath(NOTE_LOG_FILE)}'")
+        print(f"Note Copy: '{os.path.abspath(NOTE_FILE)}' (refreshed every {NOTE_COMPACT_OPS} saves)")
+        print(f"Last Change File: '{os.path.abspath(LAST_CHANGE_FILE)}'")
+        if PROFILER.active:
+            print(f"Profiling: {PROFILER.rate:.0%} of requests, slower than {PROFILER.slow_ms or '-'} ms "
+                  f"-> '{os.path.abspath(PROFILER.folder)}'")
+        if SHAPER.enabled:
+            print(f"Bandwidth: {SHAPER.client_limit or 'unlimited'} B/s per client, "
+                  f"{SHAPER.global_limit or 'unlimited'} B/s total")
+            if args.engine == "threaded":
+                print("  (each shaped transfer holds a worker thread while it runs; "
+                      "raise --workers or use --engine asyncio for many slow clients)")
+        print("Press Ctrl+C to stop the server.")
+
+    if args.engine == "asyncio":
+        executor = ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="fs")
+        print_banner(f"asyncio, {max(1, args.workers)} filesystem threads")
+        try:
+            asyncio.run(AsyncServer("", PORT, executor, reuse_port).serve_forever())
+        except KeyboardInterrupt:
+            print("\nServer stopping.")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        sys.exit(0)
+
+    SingleServer.reuse_port = ThreadPoolServer.reuse_port = reuse_port
+    if args.single:
+        httpd = SingleServer(("", PORT), CustomHandler)
+        mode = "single-threaded"
+    else:
+        ThreadPoolServer.pool_size = max(1, args.workers)
+        httpd = ThreadPoolServer(("", PORT), CustomHandler)
+        mode = f"{ThreadPoolServer.pool_size} worker threads"
+
+    with httpd:
+        print_banner(mode)
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
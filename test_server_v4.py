@@ -0,0 +1,428 @@
+"""Tests for server_v.4.py.
+
+Most test classes start the server in a scratch directory on a free port,
+the same way benchmark.py does, and talk to it over real sockets; the
+parsers and helpers are also tested directly on the imported module:
+
+    python -m unittest test_server_v4
+"""
+import base64
+import hashlib
+import http.client
+import importlib.util
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, "server_v.4.py")
+WORKER_POOL_SIZE = 16 # server_v.4.py's default --workers
+
+
+def load_server():
+    """Imports server_v.4.py as a module; it creates its shared folder in the working directory."""
+    previous = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix="server-v4-module-"))
+    try:
+        spec = importlib.util.spec_from_file_location("server_v4", SERVER)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        os.chdir(previous)
+
+server = load_server()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs one server for the whole class; `args` are extra command line arguments."""
+    args = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix="server-v4-test-")
+        shutil.copy(os.path.join(HERE, "template.html"), cls.workdir)
+        os.makedirs(os.path.join(cls.workdir, "shared"))
+        cls.port = free_port()
+        cls.log = open(os.path.join(cls.workdir, "server.log"), "wb")
+        cls.process = subprocess.Popen([sys.executable, SERVER, str(cls.port)] + cls.args,
+                                       cwd=cls.workdir, stdout=cls.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 30
+        while True:
+            if cls.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {cls.process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", cls.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        try:
+            cls.process.wait(10)
+        except subprocess.TimeoutExpired:
+            cls.process.kill()
+            cls.process.wait()
+        cls.log.close()
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def request(self, method, path, body=None, headers=None, timeout=10):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+class IdleKeepAliveTest(ServerTestCase):
+
+    def test_idle_connections_dont_starve_new_clients(self):
+        # More idle keep-alive connections than pool workers, each after one request
+        idle = []
+        try:
+            for _ in range(WORKER_POOL_SIZE + 4):
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+                connection.request("GET", "/api/note")
+                connection.getresponse().read()
+                idle.append(connection)
+            started = time.monotonic()
+            status, _ = self.request("GET", "/api/note")
+            self.assertEqual(status, 200)
+            self.assertLess(time.monotonic() - started, 2)
+        finally:
+            for connection in idle:
+                connection.close()
+
+    def test_keep_alive_is_kept_when_pool_is_free(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            for _ in range(3):
+                connection.request("GET", "/api/note")
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(response.status, 200)
+                time.sleep(0.2)
+            sock = connection.sock
+            connection.request("GET", "/api/note")
+            connection.getresponse().read()
+            self.assertIs(connection.sock, sock) # Same connection, not reopened
+        finally:
+            connection.close()
+
+
+class SingleIdleKeepAliveTest(IdleKeepAliveTest):
+    args = ["--single"]
+
+
+class ContentLengthTest(ServerTestCase):
+
+    def raw_status(self, content_length):
+        with socket.create_connection(("127.0.0.1", self.port), timeout=10) as sock:
+            sock.sendall(f"POST /api/note HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {content_length}\r\n\r\n{{}}".encode())
+            return int(sock.makefile("rb").readline().split()[1])
+
+    def test_invalid_content_length_is_rejected(self):
+        for value in ("-5", "abc", "+2", "1e3"):
+            with self.subTest(value=value):
+                self.assertEqual(self.raw_status(value), 400)
+        for line in self.request("GET", "/api/metrics")[1].decode().splitlines():
+            if line.startswith("http_request_body_bytes_total"):
+                self.assertGreaterEqual(float(line.split()[-1]), 0)
+
+
+class AsyncContentLengthTest(ContentLengthTest):
+    args = ["--engine", "asyncio"]
+
+
+class FileListingTest(ServerTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        os.makedirs(os.path.join(cls.workdir, "shared", "week 1"))
+        for name in ("a.txt", "b.txt", "week 1/c.txt"):
+            with open(os.path.join(cls.workdir, "shared", name), "w") as f:
+                f.write(name)
+
+    def get(self, path, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.getheader("Last-Modified"), response.read()
+        finally:
+            connection.close()
+
+    def test_walk_pages_through_the_tree(self):
+        paths, cursor = [], None
+        while True:
+            status, _, body = self.get("/api/files?depth=32&limit=1" + (f"&cursor={cursor}" if cursor else ""))
+            self.assertEqual(status, 200)
+            page = json.loads(body)
+            paths.extend(entry["path"] for entry in page["entries"])
+            cursor = page["nextCursor"]
+            if not cursor:
+                break
+        self.assertEqual(paths, ["a.txt", "b.txt", "week 1", "week 1/c.txt"])
+        self.assertEqual([e["name"] for e in json.loads(self.get("/api/files")[2])], ["a.txt", "b.txt"])
+        self.assertEqual([e["name"] for e in json.loads(self.get("/api/files?_=123")[2])], ["a.txt", "b.txt"])
+
+    def test_unchanged_page_is_not_modified(self):
+        status, last_modified, _ = self.get("/api/files?depth=32")
+        self.assertEqual(status, 200)
+        self.assertEqual(self.get("/api/files?depth=32", {"If-Modified-Since": last_modified})[0], 304)
+
+    def test_preview(self):
+        status, _, body = self.get("/api/preview?path=a.txt&chars=3")
+        self.assertEqual((status, json.loads(body)["text"]), (200, "a.t"))
+        status, _, body = self.get("/api/preview?path=a.txt&chars=abc")
+        self.assertEqual(status, 400)
+        self.assertNotIn("invalid literal", json.loads(body)["message"])
+
+    def test_malformed_cursor_is_rejected(self):
+        keys = base64.urlsafe_b64encode(json.dumps({"sort": "size", "keys": [["a", 5, "b"]]}).encode())
+        self.assertEqual(self.get("/api/files?sort=size&cursor=" + keys.decode().rstrip("="))[0], 400)
+
+
+class NoteApiTest(ServerTestCase):
+
+    def save(self, data):
+        status, body = self.request("POST", "/api/note", json.dumps(data),
+                                    {"Content-Type": "application/json"})
+        return status, json.loads(body)
+
+    def test_delta_against_current_version(self):
+        status, saved = self.save({"note": "hello"})
+        self.assertEqual(status, 200)
+        status, patched = self.save({"baseVersion": saved["version"], "delta": [[5, 5, " world"]]})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(self.request("GET", "/api/note")[1])["note"], "hello world")
+        status, conflict = self.save({"baseVersion": saved["version"], "delta": [[0, 0, "x"]]})
+        self.assertEqual(status, 409)
+        self.assertEqual(conflict["version"], patched["version"])
+
+    def test_change_event_names_the_saving_client(self):
+        events = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            events.request("GET", "/api/events")
+            stream = events.getresponse()
+            stream.fp.readline() # retry: line, sent once we are subscribed
+            status, saved = self.save({"note": "mine", "clientId": "tab-1"})
+            self.assertEqual(status, 200)
+            while not stream.fp.readline().startswith(b"event: note"):
+                pass
+            data = json.loads(stream.fp.readline().decode().partition(":")[2])
+            self.assertEqual((data["version"], data["clientId"]), (saved["version"], "tab-1"))
+        finally:
+            events.close()
+
+    def test_malformed_saves_are_rejected(self):
+        for data in (["note"], {"baseVersion": "1", "note": "x"}, {"baseVersion": 1.5, "note": "x"},
+                     {"baseVersion": True, "note": "x"}, {"note": "x", "clientId": 5}):
+            with self.subTest(data=data):
+                self.assertEqual(self.save(data)[0], 400)
+
+    def test_malformed_deltas_are_rejected(self):
+        version = self.save({"note": "abc"})[1]["version"]
+        for delta in (None, {"0": "x"}, [[True, 1, "x"]], [[0, False, "x"]], [[0, 1]], [[2, 1, "x"]],
+                      [[0, 99, "x"]], [[0, 1, 5]]):
+            with self.subTest(delta=delta):
+                self.assertEqual(self.save({"baseVersion": version, "delta": delta})[0], 400)
+        note = json.loads(self.request("GET", "/api/note")[1])
+        self.assertEqual((note["note"], note["version"]), ("abc", version))
+
+
+class UploadSessionTest(ServerTestCase):
+
+    def start(self, data):
+        status, body = self.request("POST", "/api/uploads", json.dumps(data), {"Content-Type": "application/json"})
+        return status, json.loads(body)
+
+    def test_malformed_sessions_are_rejected(self):
+        for data in ([], {"name": "a.txt", "size": True}, {"name": "a.txt", "size": -1},
+                     {"name": ".blobs", "size": 1}, {"name": ".~upload-x.part", "size": 1}):
+            with self.subTest(data=data):
+                self.assertEqual(self.start(data)[0], 400)
+        self.assertEqual(self.start({"name": "a.txt", "size": 1})[0], 201)
+
+    def put(self, session, offset, data, headers=None):
+        return self.request("PUT", f"/api/uploads/{session['id']}?offset={offset}", data, headers)[0]
+
+    def finish(self, session, sha256=None):
+        status, body = self.request("POST", f"/api/uploads/{session['id']}/finish",
+                                    json.dumps({"sha256": sha256}) if sha256 else None)
+        return status, json.loads(body)
+
+    def test_session_error_paths(self):
+        data = b"0123456789"
+        session = self.start({"name": "session.txt", "size": len(data)})[1]
+        self.assertEqual(self.put(session, 8, data[:4]), 400) # Past the declared size
+        self.assertEqual(self.put(session, -1, data[:4]), 400)
+        self.assertEqual(self.put(session, 0, data[:4], {"X-Chunk-SHA256": "0" * 64}), 422)
+        self.assertEqual(self.put(session, 0, data[:4]), 200)
+        status, body = self.finish(session)
+        self.assertEqual((status, body["offset"]), (409, 4)) # Not complete yet
+        self.assertEqual(self.put(session, 4, data[4:]), 200)
+        status, _ = self.finish(session, hashlib.sha256(b"something else").hexdigest())
+        self.assertEqual(status, 422)
+        status, body = self.request("GET", f"/api/uploads/{session['id']}")
+        self.assertEqual((status, json.loads(body)["offset"]), (200, 0)) # Must be sent again
+        self.assertEqual(self.put(session, 0, data), 200)
+        status, body = self.finish(session, hashlib.sha256(data).hexdigest())
+        self.assertEqual((status, body["uploaded"]), (200, ["session.txt"]))
+        with open(os.path.join(self.workdir, "shared", "session.txt"), "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.finish(session)[0], 404) # Gone once finished
+
+
+class Part:
+    """Multipart sink that records what it was given."""
+
+    def __init__(self, headers):
+        self.name = headers.get_param("name", header="Content-Disposition")
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        pass
+
+
+class MultipartParserTest(unittest.TestCase):
+    BOUNDARY = b"----formBoundary7MA4YWxk"
+
+    def parse(self, body, chunk_size):
+        parts = []
+        def on_part(headers):
+            parts.append(Part(headers))
+            return parts[-1]
+        parser = server.MultipartParser(self.BOUNDARY, on_part)
+        for start in range(0, len(body), chunk_size):
+            parser.feed(body[start:start + chunk_size])
+        return parser, parts
+
+    def body(self, *fields, end=b"--\r\n"):
+        body = b"preamble\r\n"
+        for name, data in fields:
+            body += (b"--" + self.BOUNDARY + b"\r\nContent-Disposition: form-data; name=\"" + name.encode()
+                     + b"\"\r\n\r\n" + data + b"\r\n")
+        return body + b"--" + self.BOUNDARY + end
+
+    def test_boundary_split_across_chunks(self):
+        # Data that looks like a boundary but isn't one must come through intact
+        fields = [("a", b"first\r\n--" + self.BOUNDARY[:-1] + b"x"), ("b", b""), ("c", b"third" * 100)]
+        body = self.body(*fields)
+        for chunk_size in range(1, len(self.BOUNDARY) + 8):
+            with self.subTest(chunk_size=chunk_size):
+                parser, parts = self.parse(body, chunk_size)
+                self.assertTrue(parser.finished)
+                self.assertEqual([(part.name, part.data) for part in parts], fields)
+                self.assertTrue(all(part.closed for part in parts))
+
+    def test_truncated_body_is_not_finished(self):
+        body = self.body(("a", b"data"), end=b"")[:-len(self.BOUNDARY) - 2] + b"--"
+        self.assertTrue(body.endswith(b"data\r\n--"))
+        for chunk_size in (1, 7, len(body)):
+            with self.subTest(chunk_size=chunk_size):
+                parser, parts = self.parse(body, chunk_size)
+                self.assertFalse(parser.finished)
+                self.assertFalse(parts[0].closed)
+                self.assertEqual(parts[0].data, b"data"[:len(parts[0].data)])
+
+    def test_bad_boundary_line(self):
+        with self.assertRaises(server.MultipartError):
+            self.parse(b"--" + self.BOUNDARY + b"junk\r\n", 64)
+
+
+class RangeHeaderTest(unittest.TestCase):
+
+    def test_ranges(self):
+        cases = {
+            "bytes=0-3": [(0, 3)],
+            "bytes=-3": [(7, 9)], # Suffix: the last 3 bytes
+            "bytes=-20": [(0, 9)],
+            "bytes=5-": [(5, 9)],
+            "bytes=8-20": [(8, 9)],
+            "bytes=0-4,3-6,8-": [(0, 6), (8, 9)], # Overlapping ranges are merged
+            "bytes=6-7, 0-1,2-3": [(0, 3), (6, 7)], # And adjacent ones, after sorting
+            "bytes=10-": [], # Unsatisfiable
+            "bytes=-0": [],
+            "bytes=10-12,20-": [],
+            "bytes=5-2": None, # Malformed: serve the whole file
+            "bytes=a-b": None,
+            "bytes=3": None,
+            "items=0-1": None,
+            "bytes=": None,
+        }
+        for value, expected in cases.items():
+            with self.subTest(value=value):
+                self.assertEqual(server.parse_range_header(value, 10), expected)
+
+    def test_too_many_ranges(self):
+        value = "bytes=" + ",".join(f"{i}-{i}" for i in range(0, 2 * server.MAX_RANGES + 2, 2))
+        self.assertIsNone(server.parse_range_header(value, 1000))
+        self.assertEqual(len(server.parse_range_header(value.rpartition(",")[0], 1000)), server.MAX_RANGES)
+
+
+class ApplyDeltaTest(unittest.TestCase):
+
+    def test_splices(self):
+        self.assertEqual(server.apply_delta("hello", [[5, 5, " world"], [0, 1, "H"]]), "Hello world")
+        # Offsets are UTF-16 code units, like JavaScript string indices
+        self.assertEqual(server.apply_delta("a\U0001F600b", [[3, 4, "c"]]), "a\U0001F600c")
+
+    def test_malformed_deltas(self):
+        for delta in ([[True, 1, "x"]], [[0, False, "x"]], [[0, 1]], [[0, 1, "x", 2]], [[0, 1, 5]],
+                      [["0", 1, "x"]], [[2, 1, "x"]], [[-1, 0, "x"]], [[0, 9, "x"]], [[2, 2, "x"]], [5]):
+            with self.subTest(delta=delta):
+                with self.assertRaises((ValueError, TypeError)):
+                    server.apply_delta("a\U0001F600", delta) # [[2, 2, ...]] splits the emoji
+
+
+class ZipStreamTest(unittest.TestCase):
+
+    def test_archive_of_visible_files(self):
+        root = tempfile.mkdtemp(prefix="server-v4-zip-")
+        self.addCleanup(shutil.rmtree, root)
+        files = {"a.txt": b"text " * 1000, "sub/b.png": os.urandom(3 * 1024 * 1024), "empty.txt": b""}
+        for name, data in dict(files, **{".blobs/x": b"hidden", "sub/Thumbs.db": b"hidden"}).items():
+            os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+            with open(os.path.join(root, name), "wb") as f:
+                f.write(data)
+        chunks = list(server.zip_stream(root))
+        self.assertGreater(len(chunks), 1) # Streamed, not built in one piece
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({name: archive.read(name) for name in archive.namelist()}, files)
+            self.assertEqual(archive.getinfo("sub/b.png").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo("a.txt").compress_type, zipfile.ZIP_DEFLATED)
+
+
+if __name__ == "__main__":
+    unittest.main()